@@ -160,7 +160,7 @@ def main(
         interactive_mode=True
 ):
     full_cfg_path = Path(__file__).parent.parent / 'config' / f'{cfg_path}.yaml'
-    cfg = load_config(full_cfg_path)
+    cfg = load_config(full_cfg_path)  # Embedding models load in the background, and are shared by all runs
 
     stats = {}
     for instruction, check_fn_initial_state_extractor, check_fn, required_objs_fn, feasibility_fn in instructions_unseen:
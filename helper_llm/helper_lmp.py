@@ -3,9 +3,10 @@
 import sys
 import traceback
 from pathlib import Path
-from typing import List
+from typing import List, Dict, Callable
 
 import numpy as np
+import torch
 from langchain.embeddings import CacheBackedEmbeddings
 from langchain.embeddings.base import Embeddings
 from langchain.embeddings.openai import OpenAIEmbeddings
@@ -14,6 +15,7 @@ from langchain.storage import LocalFileStore
 
 from lmp.code_execution import CodeExecutionEnvironment
 from lmp.lmp import LMPBase
+from lmp.prompt_index import PromptIndex
 from lmp.repl.semantic_hint_errror import SemanticHintError
 from .prompt_db import HelperPromptDB
 
@@ -24,7 +26,8 @@ class HelperLMP(LMPBase):
                  code_execution_env: CodeExecutionEnvironment,
                  embedding_model: Embeddings = None,
                  prompt_db: HelperPromptDB = None,
-                 top_k=3
+                 top_k=3,
+                 retrieval: Dict = None  # See lmp.vector_search.create_vector_search, exact search by default
                  ) -> None:
         super().__init__(llm, code_execution_env)
         if embedding_model is None:
@@ -38,18 +41,21 @@ class HelperLMP(LMPBase):
         self.exec_hist = ''
         self.prompt_db = prompt_db if prompt_db else HelperPromptDB()
         self.last_executed_cmd_and_plan = None
+        encoder = _EmbeddingsEncoder(self.embedding_model)
+        self._example_index = PromptIndex(encoder, retrieval)
+        self._error_index = PromptIndex(encoder, retrieval)
 
     @property
-    def embeddings(self) -> np.ndarray:
-        ex_keys = [ex.split('\n')[0].split('dialogue: ')[-1]
-                   for ex in self.prompt_db.all_examples]
-        return np.asarray(self.embedding_model.embed_documents(ex_keys))
+    def example_index(self) -> PromptIndex:
+        self._example_index = _sync_index(self._example_index, self.prompt_db.all_examples,
+                                          lambda ex: ex.split('\n')[0].split('dialogue: ')[-1])
+        return self._example_index
 
     @property
-    def error_embeddings(self) -> np.ndarray:
-        ex_keys = [ex.split('\nInput dialogue:')[0]
-                   for ex in self.prompt_db.examples_errors]
-        return np.asarray(self.embedding_model.embed_documents(ex_keys))
+    def error_index(self) -> PromptIndex:
+        self._error_index = _sync_index(self._error_index, self.prompt_db.examples_errors,
+                                        lambda ex: ex.split('\nInput dialogue:')[0])
+        return self._error_index
 
     def __call__(self, command: str, max_errors=3):
         command = '<Commander> ' + command
@@ -121,7 +127,7 @@ class HelperLMP(LMPBase):
 
     def _retrieve_examples(self, command):
         return self._retrieve_examples_from(
-            command, self.prompt_db.all_examples, self.embeddings,
+            command, self.example_index,
             base_prompt="Here are a few examples of typical inputs and outputs (only for in-context reference):\n",
             separator='\n'
         )
@@ -129,24 +135,42 @@ class HelperLMP(LMPBase):
     def _retrieve_example_errors(self, failure_line, error):
         examples_input_prompt = f'Failed subgoal:\n{failure_line}\nExecution error: {error}'
         return self._retrieve_examples_from(
-            examples_input_prompt, self.prompt_db.examples_errors, self.error_embeddings,
+            examples_input_prompt, self.error_index,
             base_prompt="Here are a few examples of typical inputs and outputs:\n",
             separator='"""\n'
         )
 
-    def _retrieve_examples_from(self, command, example_set: List[str], embeddings: np.ndarray,
-                                base_prompt: str, separator: str):
-        embedding = self.embedding_model.embed_query(command)
-        embedding = np.asarray(embedding)
+    def _retrieve_examples_from(self, command, index: PromptIndex, base_prompt: str, separator: str):
+        embedding = torch.as_tensor(np.asarray(self.embedding_model.embed_query(command), dtype=np.float32))
         # nearest neighbor
-        distance = np.linalg.norm(embeddings - embedding[None, :], axis=1)
-        distance_argsort_topk = np.argsort(distance)[:self.top_k]
+        top_indices = index.search(embedding, self.top_k)
         example_text = base_prompt
         example_number = 1
-        for idx in list(distance_argsort_topk):
+        for idx in top_indices:
             example_text += f'Example #{example_number}:\n' + separator
-            example_text += example_set[idx]
+            example_text += index.prompts[idx]
             example_text += '\n' + separator
             example_number += 1
-        print(f"most relevant examples are: {list(distance_argsort_topk)}")
+        print(f"most relevant examples are: {top_indices}")
         return example_text
+
+
+class _EmbeddingsEncoder:
+    """Adapts a langchain Embeddings model to the encode(...) of SentenceTransformer, as used by PromptIndex"""
+
+    def __init__(self, embedding_model: Embeddings) -> None:
+        super().__init__()
+        self.embedding_model = embedding_model
+
+    def encode(self, texts: List[str], convert_to_tensor=True) -> torch.Tensor:
+        assert convert_to_tensor
+        return torch.as_tensor(np.asarray(self.embedding_model.embed_documents(texts), dtype=np.float32))
+
+
+def _sync_index(index: PromptIndex, examples: List[str], key_fn: Callable[[str], str]) -> PromptIndex:
+    # Examples are usually only appended (see HelperPromptDB.store_new_example), so only new ones need to be encoded.
+    # Otherwise (learned samples removed from a shared memory_db), the index is rebuilt.
+    if index.prompts != examples[:len(index.prompts)]:
+        index = PromptIndex(index.sim_model, index.retrieval_cfg)
+    index.add([(ex, [(key_fn(ex), None)]) for ex in examples[len(index.prompts):]])
+    return index
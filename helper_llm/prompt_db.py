@@ -3,9 +3,13 @@ from functools import cached_property
 from pathlib import Path
 from typing import List
 
+from lmp.memory_store import MemoryCollection, get_memory_store
+
 
 class HelperPromptDB:
-    def __init__(self, prompt_base_dir: Path = Path(__file__).parent / 'prompts'):
+    def __init__(self, prompt_base_dir: Path = Path(__file__).parent / 'prompts',
+                 memory_db: Path = None,  # SQLite database to share learned samples with other processes
+                 memory_collection='helper'):
         super().__init__()
         self.prompt_plan = (prompt_base_dir / 'prompt_plan.txt').read_text().strip()
         self.prompt_replan = (prompt_base_dir / 'prompt_replan.txt').read_text().strip()
@@ -18,18 +22,31 @@ class HelperPromptDB:
             for f in (prompt_base_dir / 'example_errors').iterdir()
         ]
         self.learned_samples_file = prompt_base_dir / 'learned_samples.json'
+        self.memory = MemoryCollection(get_memory_store(memory_db), memory_collection) if memory_db else None
 
     @cached_property
     def learned_samples(self) -> List[str]:
+        if self.memory is not None:
+            return self.memory.load()
         if not self.learned_samples_file.is_file():
             return []
         return json.loads(self.learned_samples_file.read_text())
 
     @property
     def all_examples(self):
+        if self.memory is not None:
+            # Learned (or removed) by other processes, or stored by us
+            removed, added = self.memory.fetch_changes()
+            for sample in removed:
+                if sample in self.learned_samples:
+                    self.learned_samples.remove(sample)
+            self.learned_samples.extend(added)
         return self.examples + self.learned_samples
 
     def store_new_example(self, example: str):
+        if self.memory is not None:
+            self.memory.append(example)
+            return
         new_samples = self.learned_samples + [example]
         self.learned_samples_file.write_text(json.dumps(new_samples))
         # noinspection PyPropertyAccess
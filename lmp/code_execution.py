@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from types import NoneType, FunctionType
+from functools import lru_cache
+from types import NoneType, FunctionType, MappingProxyType
 from typing import Any, Dict
 
 import numpy as np
@@ -8,6 +9,7 @@ from .namespace import DynamicNamespaceDict
 from .util import print_code
 
 _MAX_DYNAMIC_EXECUTION_RECURSION_DEPTH = 10
+_COMPILE_CACHE_SIZE = 1024
 
 
 @dataclass
@@ -63,56 +65,130 @@ class CodeExecutionEnvironment:
 
 
 def _exec_safe(code_str, global_vars=None, eval_mode=False) -> _ExecutionResult:
-    banned_phrases = ['import', '__']
-    for phrase in banned_phrases:
-        if phrase in code_str:
-            raise ImportError(code_str)
+    code = _compile_safe(code_str, 'eval' if eval_mode else 'exec')
 
     if global_vars is None:
         global_vars = {}
-    global_vars = _deep_copy_except_complex_types(global_vars)
-    global_vars.update(exec=_empty_fn, eval=_empty_fn, compile=_empty_fn)
-    # noinspection PyTypeChecker
-    global_vars['__builtins__'] = dict(__builtins__)
-    global_vars['__builtins__'].update(exec=_empty_fn, eval=_empty_fn, open=_empty_fn,
-                                       compile=_empty_fn, input=_empty_fn, exit=_empty_fn)
-    global_vars['__builtins__']['__import__'] = None
-
     # The parameter "locals" for exec/eval is set to none because it has a weird semantic.
     #   see https://docs.python.org/3.10/library/functions.html#exec
     # Instead, everything is written into globals and then extracted from there.
-    all_keys_before = set(global_vars.keys())
-    primitive_globals_before = {k: v for k, v in global_vars.items() if _is_primitive_value(v)}
-    # to properly detect in-place modifications of containers, do a deep copy before
-    primitive_globals_before = _deep_copy_except_complex_types(primitive_globals_before)
-    function_defs_before = {k: v for k, v in global_vars.items() if isinstance(v, FunctionType)}
+    global_vars = _WriteTrackingGlobals(global_vars)
+    global_vars.update(_SANDBOX_GLOBALS)
+    if any(phrase in code_str for phrase in _UNTRACKED_WRITE_PHRASES):
+        global_vars.take_snapshot()
+
     if eval_mode:
         print('\n\n', '=' * 30, '\n\n')
         print('eval', code_str)
-        return_value = eval(code_str, global_vars, None)
+        return_value = eval(code, global_vars, None)
     else:
         print('\n\n', '=' * 30, '\n\n')
         print_code(code_str)
-        exec(code_str, global_vars, None)
+        exec(code, global_vars, None)
         return_value = None
 
-    # Keep variables that appeared newly or changed
-    # New values can be anything including functions (to allow dynamic function definitions)
-    # Functions are tracked so that self-defined functions can be redefined.
-    primitive_globals_after = {k: v for k, v in global_vars.items()
-                               if _is_primitive_value(v) and k in primitive_globals_before}
-    changed_keys = {k for k in primitive_globals_before.keys()
-                    if not _save_equals(primitive_globals_after.get(k), primitive_globals_before[k])
-                    } | {k for k in function_defs_before.keys() if global_vars[k] != function_defs_before[k]}
-    new_keys = global_vars.keys() - all_keys_before
-    local_vars = {}
-    for k in new_keys | changed_keys:
-        local_vars[k] = global_vars[k]
+    local_vars = global_vars.defined_local_vars()
     print('Updated/Defined variables after execution:', local_vars)
 
     return _ExecutionResult(return_value, local_vars)
 
 
+@lru_cache(maxsize=_COMPILE_CACHE_SIZE)
+def _compile_safe(code_str: str, mode: str):
+    """Validate and compile code. Cached, since the same statements (e.g. wait_for_trigger()) recur constantly."""
+    check_banned_phrases(code_str)
+    if mode == 'eval':
+        code_str = code_str.lstrip(' \t')  # Like eval() does with a string, e.g. for an indented expression line
+    return compile(code_str, '<string>', mode)
+
+
+def check_banned_phrases(code_str: str):
+    banned_phrases = ['import', '__']
+    for phrase in banned_phrases:
+        if phrase in code_str:
+            raise ImportError(code_str)
+
+
+def compile_cache_stats() -> Dict[str, Any]:
+    info = _compile_safe.cache_info()
+    lookups = info.hits + info.misses
+    return dict(info._asdict(), hit_rate=info.hits / lookups if lookups else 0.)
+
+
+# Writes that bypass the mapping interface (STORE_GLOBAL in nested functions, globals().update(), ...)
+_UNTRACKED_WRITE_PHRASES = ('global', 'vars(')
+_MISSING = object()
+
+
+class _WriteTrackingGlobals(dict):
+    """
+    Globals mapping for exec/eval which records the names a statement touches, so that changed variables can be
+    determined without copying and comparing the whole namespace.
+
+    Containers are copied lazily on first read, so in-place modifications happen on a private copy (as with the full
+    deep copy before) and can be compared against the untouched original afterwards.
+    """
+
+    def __init__(self, global_vars) -> None:
+        super().__init__(global_vars)
+        self._originals = {}  # name -> value before execution (_MISSING for names defined during execution)
+        self._snapshot = None
+
+    def take_snapshot(self):
+        """Fallback for code that might write without going through __setitem__"""
+        self._snapshot = dict(self)
+
+    def _touch(self, key):
+        if key not in self._originals:
+            self._originals[key] = dict.get(self, key, _MISSING)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if key not in self._originals and type(value) in (list, tuple, set, dict):
+            self._originals[key] = value
+            value = _deep_copy_except_complex_types(value)
+            super().__setitem__(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._touch(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._touch(key)
+        super().__delitem__(key)
+
+    def defined_local_vars(self):
+        """
+        Variables that appeared newly or changed.
+        New values can be anything including functions (to allow dynamic function definitions).
+        Functions are tracked so that self-defined functions can be redefined.
+        """
+        originals = self._originals
+        if self._snapshot is not None:
+            originals = dict(originals)
+            for k, v in self._snapshot.items():
+                if k not in originals and dict.get(self, k, _MISSING) is not v:
+                    originals[k] = v
+            originals.update((k, _MISSING) for k in self.keys() - self._snapshot.keys())
+        local_vars = {}
+        for k, before in originals.items():
+            if k not in self:
+                continue  # Deleted during execution
+            after = dict.__getitem__(self, k)
+            if before is _MISSING:
+                changed = True
+            elif _is_primitive_value(before):
+                changed = not _save_equals(after if _is_primitive_value(after) else None, before)
+            elif isinstance(before, FunctionType):
+                changed = after != before
+            else:
+                changed = False
+            if changed:
+                local_vars[k] = after
+        return local_vars
+
+
 def _save_equals(x, y):
     t1 = type(x)
     t2 = type(y)
@@ -162,3 +238,15 @@ def _deep_copy_except_complex_types(x):
 
 def _empty_fn(*args, **kwargs):
     pass
+
+
+# The restricted builtins, shared by all executions (of all namespaces) instead of copied for each one. They are a
+# read-only view, so that executed code cannot replace builtins for later executions, even if it reaches them via
+# globals(). Only the mapping is frozen, the builtin objects themselves are the regular ones.
+# noinspection PyTypeChecker
+_SANDBOX_BUILTINS = dict(__builtins__)
+_SANDBOX_BUILTINS.update(exec=_empty_fn, eval=_empty_fn, open=_empty_fn,
+                         compile=_empty_fn, input=_empty_fn, exit=_empty_fn)
+_SANDBOX_BUILTINS['__import__'] = None
+_SANDBOX_BUILTINS = MappingProxyType(_SANDBOX_BUILTINS)
+_SANDBOX_GLOBALS = dict(exec=_empty_fn, eval=_empty_fn, compile=_empty_fn, __builtins__=_SANDBOX_BUILTINS)
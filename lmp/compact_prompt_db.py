@@ -0,0 +1,65 @@
+"""
+Offline near-duplicate compaction of the learned prompts of all LMPs in a config (see lmp.prompt_compaction).
+Running LMPs that share a memory_db pick up the removals with their next retrieval.
+
+Usage: python -m lmp.compact_prompt_db [config, relative to config/ and without .yaml] [threshold]
+"""
+import sys
+from functools import partial
+from pathlib import Path
+from typing import Dict
+
+from lmp.dynamic_cap_lmp import DynamicCapLMP
+from lmp.embedding_store import DEFAULT_EMBEDDING_CACHE_DIR, create_prompt_encoder
+from lmp.memory_store import open_custom_prompt_storage
+from lmp.prompt_compaction import NearDuplicateDetector, find_near_duplicates
+from lmp.prompt_journal import PromptJournal
+from lmp.repl.dynamic_prompt import DynamicPromptBuilder
+from lmp.setup import load_config, embedding_model_device
+
+
+def _lmp_cfgs(cfg: Dict, seen=None):
+    """The config and all imported ones, each once"""
+    seen = set() if seen is None else seen
+    if id(cfg) in seen:
+        return
+    seen.add(id(cfg))
+    yield cfg
+    for sub_cfg in cfg.get('import_lmps', {}).values():
+        yield from _lmp_cfgs(sub_cfg, seen)
+
+
+def compact(cfg: Dict, threshold: float = None):
+    prompt_cfg = cfg['prompt_cfg']
+    storage = open_custom_prompt_storage(prompt_cfg.get('custom_prompt_db_file'), prompt_cfg.get('memory_db'),
+                                         prompt_cfg.get('memory_collection'))
+    if storage is None:
+        return
+    if cfg.get('type') == 'repl':
+        signature_fn = DynamicPromptBuilder.duplicate_signature
+    else:
+        signature_fn = partial(DynamicCapLMP.command_of,
+                               context_prefix_length=prompt_cfg.get('context_prefix_length', 1))
+    encoder = create_prompt_encoder(prompt_cfg['sentence_similarity_model'], embedding_model_device(cfg),
+                                    prompt_cfg.get('embedding_cache_dir', DEFAULT_EMBEDDING_CACHE_DIR),
+                                    prompt_cfg.get('memory_db'))
+    threshold = threshold or prompt_cfg.get('near_duplicate_threshold') or 0.95
+    prompts = storage.load()
+    duplicates = find_near_duplicates(prompts, NearDuplicateDetector(encoder, signature_fn, threshold))
+    for duplicate, canonical in duplicates:
+        print('Removing near-duplicate:', repr(signature_fn(duplicate)))
+        storage.remove(duplicate)
+    if isinstance(storage, PromptJournal):
+        storage.compact()
+    print(f'{storage}: removed {len(duplicates)} of {len(prompts)} learned prompts')
+
+
+def main(cfg_path='cap_tabletop/repl_flat_fgen/repl', threshold: float = None):
+    cfg = load_config(Path(__file__).parent.parent / 'config' / f'{cfg_path}.yaml')
+    for lmp_cfg in _lmp_cfgs(cfg):
+        if 'prompt_cfg' in lmp_cfg:
+            compact(lmp_cfg, threshold)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2], *[float(t) for t in sys.argv[2:3]])
@@ -1,12 +1,14 @@
-import json
-from functools import cached_property
+from functools import partial
 from pathlib import Path
 
 from langchain.schema.language_model import BaseLanguageModel
-from sentence_transformers import SentenceTransformer, util
 
 from .code_execution import CodeExecutionEnvironment
+from .embedding_models import get_embedding_model
+from .embedding_store import DEFAULT_EMBEDDING_CACHE_DIR, create_prompt_encoder
+from .learned_prompts import LearnedPrompts
 from .lmp import LMP
+from .memory_store import open_custom_prompt_storage
 
 
 class DynamicCapLMP(LMP):
@@ -23,36 +25,56 @@ class DynamicCapLMP(LMP):
         self.top_k = prompt_cfg['top_k']
         self.predefined_prompt_db = prompt_cfg['prompt_db']
         self.custom_prompt_db_file = Path(custom_prompt_db_file) if custom_prompt_db_file else None
-        self.custom_prompt_db = (json.loads(self.custom_prompt_db_file.read_text())
-                                 if custom_prompt_db_file and self.custom_prompt_db_file.exists() else [])
-        if self.custom_prompt_db:
-            print('Loaded', len(self.custom_prompt_db), 'samples from', self.custom_prompt_db_file)
-        self.sim_model = SentenceTransformer(prompt_cfg['sentence_similarity_model'])
+        memory_db = prompt_cfg.get('memory_db')
+        storage = open_custom_prompt_storage(custom_prompt_db_file, memory_db, prompt_cfg.get('memory_collection'))
+        self.sim_model = get_embedding_model(prompt_cfg['sentence_similarity_model'], prompt_cfg.get('device'))
         self._context_prefix_length = prompt_cfg.get('context_prefix_length', 1)  # in lines
+        self._learned_prompts = LearnedPrompts(
+            self.predefined_prompt_db, storage,
+            create_prompt_encoder(prompt_cfg['sentence_similarity_model'], prompt_cfg.get('device'),
+                                  prompt_cfg.get('embedding_cache_dir', DEFAULT_EMBEDDING_CACHE_DIR), memory_db),
+            index_keys_fn=self._index_keys,
+            signature_fn=partial(self.command_of, context_prefix_length=self._context_prefix_length),
+            retrieval_cfg=prompt_cfg.get('retrieval'),
+            # Do not store near-duplicates of learned examples (e.g. 0.95), None to store all
+            near_duplicate_threshold=prompt_cfg.get('near_duplicate_threshold'),
+            # Maximum number of learned examples (needs a custom_prompt_db_file or memory_db), None for unbounded
+            capacity=prompt_cfg.get('capacity'),
+            # Learned examples to remove when over capacity: least frequently (lfu) or recently (lru) used
+            eviction=prompt_cfg.get('eviction', 'lfu'),
+            kind='example')
+        if self.custom_prompt_db:
+            print('Loaded', len(self.custom_prompt_db), 'samples from', storage)
 
     @property
-    def _all_prompts(self):
-        return self.predefined_prompt_db + self.custom_prompt_db
-
-    @cached_property
-    def _prompt_embeddings_cache(self):
-        commands = []
-        for example in self._all_prompts:
-            cmd_line = example.splitlines()[self._context_prefix_length]
-            assert cmd_line.startswith('#'), cmd_line
-            commands.append(cmd_line[1:])
-        return self.sim_model.encode(commands, convert_to_tensor=True)
+    def custom_prompt_db(self):
+        return self._learned_prompts.learned
+
+    def _index_keys(self, example: str):
+        return [(self.command_of(example, self._context_prefix_length), None)]
+
+    @staticmethod
+    def command_of(example: str, context_prefix_length=1):
+        cmd_line = example.splitlines()[context_prefix_length]
+        assert cmd_line.startswith('#'), cmd_line
+        return cmd_line[1:]
 
     def build_prompt(self, query, context=''):
         base_prompt, use_query = super().build_prompt(query, context)
 
+        self._learned_prompts.fetch_changes()
         encoded_query = self.sim_model.encode([query], convert_to_tensor=True)
-        similarities = util.cos_sim(encoded_query, self._prompt_embeddings_cache).squeeze()
-        top_indices = similarities.argsort(descending=True)[:self.top_k]
-        example_str = '\n'.join(self._all_prompts[i] for i in top_indices)
+        index = self._learned_prompts.index
+        top_indices = index.search(encoded_query, self.top_k)
+        example_str = '\n'.join(index.prompts[i] for i in top_indices)
+        self._learned_prompts.record_hits(top_indices)
 
         return base_prompt.replace('{EXAMPLES}', example_str), use_query
 
+    def flush_hits(self):
+        """Persist the usage statistics that are still pending, which otherwise happens when learning and at exit"""
+        self._learned_prompts.flush_hits()
+
     def reinforce_last_plan_successful(self):
         if not self.exec_hist:
             return
@@ -61,14 +83,10 @@ class DynamicCapLMP(LMP):
         cmd_line = example.splitlines()[self._context_prefix_length]
         assert cmd_line.startswith('#'), example
 
-        self.custom_prompt_db.append(example)
-        if self.custom_prompt_db_file:
-            print('Writing custom_prompt_db_file', self.custom_prompt_db_file)
-            self.custom_prompt_db_file.write_text(json.dumps(self.custom_prompt_db))
-
-        # invalidate cache
-        # noinspection PyPropertyAccess
-        del self._prompt_embeddings_cache
+        duplicate_of = self._learned_prompts.learn(example)
+        if duplicate_of is not None:
+            print('Will not store example, it is a near-duplicate of a learned one:')
+            print(duplicate_of)
 
         self.exec_hist = ''  # To prevent duplicate writing by LMPs referenced by children on different levels
         for key, value in self.code_execution_env.namespace.permanent_definitions.items():
@@ -0,0 +1,58 @@
+import threading
+from concurrent.futures import Future
+from typing import Dict, Tuple, Optional
+
+from sentence_transformers import SentenceTransformer
+
+
+class SharedEmbeddingModel:
+    """
+    A SentenceTransformer which is loaded in a background thread and shared by all LMPs of the process
+    (see get_embedding_model). Accessing the model blocks until it is loaded. Encoding is serialized, since the model
+    is not safe to use from multiple threads concurrently.
+    """
+
+    def __init__(self, name: str, device: Optional[str] = None) -> None:
+        super().__init__()
+        self.name = name
+        self._device = device
+        self._lock = threading.Lock()
+        self._loaded: Future = Future()
+        threading.Thread(target=self._load, name=f'load_{name}', daemon=True).start()
+
+    def _load(self):
+        try:
+            print('Loading embedding model', self.name)
+            model = SentenceTransformer(self.name, device=self._device)
+        except BaseException as e:
+            self._loaded.set_exception(e)
+        else:
+            self._loaded.set_result(model)
+
+    @property
+    def model(self) -> SentenceTransformer:
+        return self._loaded.result()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, *args, **kwargs):
+        model = self.model
+        with self._lock:
+            return model.encode(*args, **kwargs)
+
+
+_models: Dict[Tuple[str, Optional[str]], SharedEmbeddingModel] = {}
+_models_lock = threading.Lock()
+
+
+def get_embedding_model(name: str, device: Optional[str] = None) -> SharedEmbeddingModel:
+    """Models are loaded once per process and device. Loading starts in the background on the first request."""
+    with _models_lock:
+        if (name, device) not in _models:
+            _models[(name, device)] = SharedEmbeddingModel(name, device)
+        return _models[(name, device)]
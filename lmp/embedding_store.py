@@ -0,0 +1,185 @@
+import fcntl
+import os
+import struct
+import threading
+from functools import cached_property
+from pathlib import Path
+from typing import List, Dict, Tuple, Union
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+from .embedding_models import SharedEmbeddingModel, get_embedding_model
+from .memory_store import MemoryStore, get_memory_store
+from .util import text_key
+
+# In the user's cache directory, outside the source tree
+DEFAULT_EMBEDDING_CACHE_DIR = (Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+                               / 'interactive-incremental-robot-behavior-learning' / 'embeddings')
+
+_HEADER_SIZE = 128  # Fixed, so that the header can be rewritten in place when rows are appended
+_KEY_LINE_LENGTH = 41  # sha1 hex digest + newline
+_DTYPE = np.dtype('<f4')
+
+
+class EmbeddingStore:
+    """
+    Content-addressed on-disk store for the embeddings of one model, keyed by the hash of the embedded text.
+
+    Embeddings are rows of a memory-mapped .npy matrix, their keys are the lines of a text file next to it.
+    Both files are append-only; the key file determines which rows are valid.
+    """
+
+    def __init__(self, directory: Path, dimension: int) -> None:
+        super().__init__()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.dimension = dimension
+        self._matrix_file = directory / 'embeddings.npy'
+        self._keys_file = directory / 'keys.txt'
+        self._rows: Dict[str, int] = {}
+        self._num_keys = 0  # Lines in the key file, i.e. valid rows (might be more than len(_rows) on duplicates)
+        self._matrix = np.empty((0, dimension), dtype=_DTYPE)
+        self._lock = threading.Lock()
+        if not self._matrix_file.exists():
+            with self._matrix_file.open('wb') as f:
+                _write_header(f, 0, dimension)
+        self._keys_file.touch()
+        with self._lock:
+            self._refresh()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _refresh(self):
+        """Pick up rows appended since the last refresh (possibly by another process)"""
+        with self._keys_file.open('rb') as f:
+            f.seek(self._num_keys * _KEY_LINE_LENGTH)
+            data = f.read()
+        data = data[:len(data) // _KEY_LINE_LENGTH * _KEY_LINE_LENGTH]  # Ignore an incompletely written line
+        for key in data.decode('ascii').split():
+            self._rows.setdefault(key, self._num_keys)
+            self._num_keys += 1
+        if self._num_keys > len(self._matrix):
+            matrix = np.load(self._matrix_file, mmap_mode='r')
+            if matrix.shape[1] != self.dimension:
+                raise ValueError(f'{self._matrix_file} has embeddings of dimension {matrix.shape[1]}, '
+                                 f'expected {self.dimension}')
+            self._matrix = matrix
+
+    def get(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        """
+        :return: the embeddings of the given texts, and the indices of the texts that are not stored
+            (their rows are left uninitialized)
+        """
+        result = np.empty((len(texts), self.dimension), dtype=_DTYPE)
+        missing = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                row = self._rows.get(text_key(text))
+                if row is None:
+                    missing.append(i)
+                else:
+                    result[i] = self._matrix[row]
+        return result, missing
+
+    def add(self, texts: List[str], embeddings: np.ndarray):
+        with self._lock, self._keys_file.open('ab') as keys_f:
+            fcntl.flock(keys_f, fcntl.LOCK_EX)  # Released when the file is closed
+            self._refresh()
+            new_keys = {}
+            for text, embedding in zip(texts, embeddings):
+                key = text_key(text)
+                if key not in self._rows:
+                    new_keys.setdefault(key, embedding)
+            if not new_keys:
+                return
+            rows = np.asarray(list(new_keys.values()), dtype=_DTYPE)
+            num_rows = self._num_keys + len(rows)
+            with self._matrix_file.open('r+b') as f:
+                # Rows beyond the last key might be left over from an interrupted write, just overwrite them
+                f.seek(_HEADER_SIZE + self._num_keys * self.dimension * _DTYPE.itemsize)
+                f.write(rows.tobytes())
+                f.truncate()
+                _write_header(f, num_rows, self.dimension)
+            keys_f.write(''.join(k + '\n' for k in new_keys).encode('ascii'))
+            keys_f.flush()
+            self._refresh()
+
+
+def _write_header(f, num_rows: int, dimension: int):
+    header = repr({'descr': _DTYPE.str, 'fortran_order': False, 'shape': (num_rows, dimension)})
+    header = header.ljust(_HEADER_SIZE - 11) + '\n'
+    f.seek(0)
+    f.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+_stores: Dict[Path, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_embedding_store(cache_dir: Path, model_name: str, dimension: int) -> EmbeddingStore:
+    """Stores are shared within the process"""
+    directory = (Path(cache_dir) / model_name.replace('/', '--')).resolve()
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = EmbeddingStore(directory, dimension)
+        return _stores[directory]
+
+
+class CachingEncoder:
+    """
+    Wraps a SentenceTransformer to look up embeddings in an EmbeddingStore first. Only texts which have never been
+    encoded before are passed to the model.
+    """
+
+    def __init__(self, sim_model: Union[SentenceTransformer, SharedEmbeddingModel], model_name: str,
+                 cache_dir: Path = DEFAULT_EMBEDDING_CACHE_DIR, memory_store: MemoryStore = None):
+        """
+        :param memory_store: store the embeddings in this (shared) database instead of cache_dir
+        """
+        super().__init__()
+        self.sim_model = sim_model
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.memory_store = memory_store
+
+    @cached_property
+    def store(self):
+        # Not opened in __init__, since the dimension is only known once the model is loaded
+        dimension = self.sim_model.get_sentence_embedding_dimension()
+        if self.memory_store is not None:
+            return self.memory_store.embeddings(self.model_name, dimension)
+        return get_embedding_store(self.cache_dir, self.model_name, dimension)
+
+    @property
+    def device(self):
+        return self.sim_model.device
+
+    def get_sentence_embedding_dimension(self):
+        return self.sim_model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: List[str], convert_to_tensor=True) -> torch.Tensor:
+        assert convert_to_tensor
+        embeddings, missing = self.store.get(texts)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            print('Encoding', len(missing_texts), 'texts not found in embedding cache')
+            new_embeddings = self.sim_model.encode(missing_texts, convert_to_numpy=True)
+            self.store.add(missing_texts, new_embeddings)
+            embeddings[missing] = new_embeddings
+        return torch.from_numpy(embeddings).to(self.sim_model.device)
+
+
+def create_prompt_encoder(model_name: str, device: str = None, cache_dir: Path = DEFAULT_EMBEDDING_CACHE_DIR,
+                          memory_db: Path = None) -> Union[SharedEmbeddingModel, CachingEncoder]:
+    """
+    Encoder for prompt DB keys, caching embeddings in memory_db if given, else in cache_dir if given
+    :return: the shared model (see get_embedding_model) if there is no cache
+    """
+    sim_model = get_embedding_model(model_name, device)
+    if memory_db:
+        return CachingEncoder(sim_model, model_name, memory_store=get_memory_store(memory_db))
+    if cache_dir:
+        return CachingEncoder(sim_model, model_name, cache_dir)
+    return sim_model
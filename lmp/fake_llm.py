@@ -0,0 +1,72 @@
+import asyncio
+import time
+from typing import List, Optional, Any, Iterator, AsyncIterator
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain.llms.fake import FakeListLLM
+from langchain.schema.output import GenerationChunk
+
+
+class FakeStreamingLLM(FakeListLLM):
+    """
+    Fake LLM for tests and benchmarks without API access. Returns the given responses in turn (truncated at the first
+    stop sequence, like a real LLM), streamed in chunks of chunk_size characters which take chunk_latency seconds each.
+    streamed_chars counts the characters actually streamed, i.e. only up to the cancellation of a stream.
+    The async variants wait with asyncio instead of blocking, like a request to a remote LLM.
+
+    Can be used in configs as llm type, e.g.
+        llm:
+          type: FakeStreamingLLM
+          responses: ["say('Hello')", "wait_for_trigger()"]
+          chunk_latency: 0.02
+    """
+
+    chunk_size: int = 4  # About one token
+    chunk_latency: float = 0.0
+    streamed_chars: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-streaming-list'
+
+    def _next_response(self, stop: Optional[List[str]]) -> str:
+        response = super()._call('')
+        for s in stop or []:
+            if s in response:
+                response = response[:response.index(s)]
+        return response
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        response = self._next_response(stop)
+        time.sleep(self.chunk_latency * -(-len(response) // self.chunk_size))
+        return response
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        response = self._next_response(stop)
+        for i in range(0, len(response), self.chunk_size):
+            time.sleep(self.chunk_latency)
+            text = response[i:i + self.chunk_size]
+            self.streamed_chars += len(text)
+            if run_manager:
+                run_manager.on_llm_new_token(text)
+            yield GenerationChunk(text=text)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        response = self._next_response(stop)
+        await asyncio.sleep(self.chunk_latency * -(-len(response) // self.chunk_size))
+        return response
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        response = self._next_response(stop)
+        for i in range(0, len(response), self.chunk_size):
+            await asyncio.sleep(self.chunk_latency)
+            text = response[i:i + self.chunk_size]
+            self.streamed_chars += len(text)
+            if run_manager:
+                await run_manager.on_llm_new_token(text)
+            yield GenerationChunk(text=text)
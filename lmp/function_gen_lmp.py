@@ -1,4 +1,7 @@
 import ast
+import asyncio
+from concurrent.futures import Executor
+from typing import Optional
 
 import astunparse
 from langchain.schema.language_model import BaseLanguageModel
@@ -16,22 +19,26 @@ class FunctionGenerationLMP(LMPBase):
         self._base_prompt = self._cfg['prompt_text']
 
     def create_f_from_sig(self, f_name, f_sig):
-        print(f'Creating function: {f_sig}')
-
-        use_query = f'{self._cfg["query_prefix"]}{f_sig}{self._cfg["query_suffix"]}'
-        prompt = f'{self._base_prompt}\n{use_query}'
-
-        f_src = self.llm.predict(
-            text=prompt,
-            stop=self._stop_tokens,
-            temperature=self._cfg['temperature'],
-            max_tokens=self._cfg['max_tokens']
-        ).strip()
-
+        prompt = self._build_prompt(f_sig)
+        f_src = self.llm.predict(text=prompt, **self._llm_kwargs()).strip()
         self.code_execution_env(f_src, return_val_name=f_name, define=True)
+        return f_src
 
+    async def acreate_f_from_sig(self, f_name, f_sig, executor: Optional[Executor] = None):
+        prompt = self._build_prompt(f_sig)
+        f_src = (await self.llm.apredict(text=prompt, **self._llm_kwargs())).strip()
+        await asyncio.get_running_loop().run_in_executor(
+            executor, lambda: self.code_execution_env(f_src, return_val_name=f_name, define=True))
         return f_src
 
+    def _build_prompt(self, f_sig):
+        print(f'Creating function: {f_sig}')
+        use_query = f'{self._cfg["query_prefix"]}{f_sig}{self._cfg["query_suffix"]}'
+        return f'{self._base_prompt}\n{use_query}'
+
+    def _llm_kwargs(self):
+        return dict(stop=self._stop_tokens, temperature=self._cfg['temperature'], max_tokens=self._cfg['max_tokens'])
+
     def create_new_fs_from_code(self, code_str):
         fs = self._find_function_calls(code_str)
 
@@ -41,8 +48,7 @@ class FunctionGenerationLMP(LMPBase):
                 f_src = self.create_f_from_sig(f_name, f_sig)
 
                 # recursively define child_fs in the function body if needed
-                f_def_body = astunparse.unparse(ast.parse(f_src).body[0].body)
-                child_f_srcs = self.create_new_fs_from_code(f_def_body)
+                child_f_srcs = self.create_new_fs_from_code(self._function_body(f_src))
 
                 if len(child_f_srcs) > 0:
                     srcs.update(child_f_srcs)
@@ -55,6 +61,31 @@ class FunctionGenerationLMP(LMPBase):
 
         return srcs
 
+    async def acreate_new_fs_from_code(self, code_str, executor: Optional[Executor] = None):
+        """Like create_new_fs_from_code, but awaits the LLM calls"""
+        fs = self._find_function_calls(code_str)
+
+        srcs = {}
+        for f_name, f_sig in fs.items():
+            if not self.code_execution_env.is_defined(f_name):
+                f_src = await self.acreate_f_from_sig(f_name, f_sig, executor)
+
+                child_f_srcs = await self.acreate_new_fs_from_code(self._function_body(f_src), executor)
+
+                if len(child_f_srcs) > 0:
+                    srcs.update(child_f_srcs)
+
+                    self.code_execution_env.del_dynamic_value(f_name)
+                    f_src = await self.acreate_f_from_sig(f_name, f_sig, executor)
+
+                srcs[f_name] = f_src
+
+        return srcs
+
+    @staticmethod
+    def _function_body(f_src):
+        return astunparse.unparse(ast.parse(f_src).body[0].body)
+
     @staticmethod
     def _find_function_calls(code_str):
         fs, f_assigns = {}, {}
@@ -0,0 +1,144 @@
+from functools import cached_property
+from typing import List, Tuple, Optional, Union, Dict, Callable, Iterable, Collection
+
+from .embedding_models import SharedEmbeddingModel
+from .embedding_store import CachingEncoder
+from .memory_store import MemoryCollection, select_for_eviction, EVICTION_POLICIES
+from .prompt_compaction import NearDuplicateDetector
+from .prompt_index import PromptIndex
+from .prompt_journal import PromptJournal
+
+
+class LearnedPrompts:
+    """
+    The prompt database of an LMP: its predefined prompts, followed by the learned ones, which are read from and
+    written to a storage (see lmp.memory_store.open_custom_prompt_storage), if given.
+    Keeps the prompt index and the near-duplicate detector (both built on first use) in sync with the storage, which
+    might also be changed by other processes (see fetch_changes), and evicts learned prompts when over capacity.
+    """
+
+    def __init__(self, predefined: List[str], storage: Optional[Union[PromptJournal, MemoryCollection]],
+                 encoder: Union[SharedEmbeddingModel, CachingEncoder],
+                 index_keys_fn: Callable[[str], List[Tuple[str, Optional[str]]]],
+                 signature_fn: Callable[[str], str],
+                 retrieval_cfg: Dict = None,  # See lmp.vector_search.create_vector_search
+                 near_duplicate_threshold: float = None,  # Do not learn near-duplicates of learned prompts (see learn)
+                 capacity: int = None,  # Maximum number of learned prompts (needs a storage), None for unbounded
+                 eviction='lfu',  # Learned prompts to remove when over capacity: least frequently or recently used
+                 kind='prompt') -> None:  # What the prompts are called in messages, e.g. 'interaction'
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f'Unknown eviction policy {eviction}, expected one of {EVICTION_POLICIES}')
+        self.predefined = predefined
+        self.storage = storage
+        self.learned: List[str] = storage.load() if storage else []
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.capacity = capacity
+        self.eviction = eviction
+        self.kind = kind
+        self._encoder = encoder
+        self._index_keys_fn = index_keys_fn
+        self._signature_fn = signature_fn
+        self._retrieval_cfg = retrieval_cfg
+
+    def __len__(self):
+        return len(self.predefined) + len(self.learned)
+
+    @property
+    def prompts(self) -> List[str]:
+        return self.predefined + self.learned
+
+    @cached_property
+    def index(self) -> PromptIndex:
+        """Predefined prompts precede the learned ones"""
+        index = PromptIndex(self._encoder, self._retrieval_cfg)
+        index.add([(p, self._index_keys_fn(p)) for p in self.prompts])
+        return index
+
+    @cached_property
+    def duplicate_detector(self) -> NearDuplicateDetector:
+        detector = NearDuplicateDetector(self._encoder, self._signature_fn, self.near_duplicate_threshold)
+        for p in self.learned:
+            detector.add(p)
+        return detector
+
+    def warm_up(self):
+        """Build the index (and the near-duplicate detector, if used) now"""
+        _ = self.index
+        if self.near_duplicate_threshold is not None:
+            _ = self.duplicate_detector
+
+    def learn(self, prompt: str) -> Optional[str]:
+        """
+        Store the prompt, unless it is a near-duplicate of a learned one (if near_duplicate_threshold is set), and
+        evict learned prompts if there are more than capacity
+        :return: the learned prompt that the given one duplicates, which is then not stored
+        """
+        if self.near_duplicate_threshold is not None:
+            self.fetch_changes()
+            duplicate_of = self.duplicate_detector.find_duplicate(prompt)
+            if duplicate_of is not None:
+                return duplicate_of
+
+        if self.storage:
+            print(f'Storing {self.kind} in', self.storage)
+            self.storage.append(prompt)
+            self.fetch_changes()
+            self._evict(keep={prompt})
+        else:
+            self._add([prompt])
+        return None
+
+    def record_hits(self, indices: Iterable[int]):
+        """Usage statistics for eviction, of the retrieved learned prompts (given by their index positions)"""
+        learned = [self.index.prompts[i] for i in indices if i >= len(self.predefined)]
+        if learned and self.storage:
+            self.storage.record_hits(learned)
+
+    def flush_hits(self):
+        """Persist the usage statistics that are still pending, which otherwise happens when learning and at exit"""
+        if self.storage:
+            self.storage.flush_hits()
+
+    def _evict(self, keep: Collection[str]):
+        if self.capacity is None or not self.storage:
+            return
+        victims = select_for_eviction(self.learned, self.storage.usage(), self.capacity, self.eviction, keep)
+        for p in victims:
+            print(f'Evicting learned {self.kind} ({self.eviction}, capacity {self.capacity}):')
+            print(p)
+            self.storage.remove(p)
+        if victims:
+            self.fetch_changes()
+
+    def fetch_changes(self):
+        """
+        Pick up prompts learned (or removed by compaction or eviction) since the last call, including those of other
+        processes sharing the storage
+        """
+        if self.storage:
+            removed, added = self.storage.fetch_changes()
+            self._remove(removed)
+            self._add(added)
+
+    def _add(self, prompts: List[str]):
+        if not prompts:
+            return
+        self.learned.extend(prompts)
+        # update caches, if already computed
+        if 'duplicate_detector' in self.__dict__:
+            for p in prompts:
+                self.duplicate_detector.add(p)
+        if 'index' in self.__dict__:
+            self.index.add([(p, self._index_keys_fn(p)) for p in prompts])
+
+    def _remove(self, prompts: List[str]):
+        for p in prompts:
+            if p not in self.learned:
+                continue
+            self.learned.remove(p)
+            # update caches, if already computed
+            if 'duplicate_detector' in self.__dict__:
+                self.duplicate_detector.remove(p)
+            if 'index' in self.__dict__:
+                # The last occurrence, since a predefined prompt with the same text might precede it
+                self.index.remove(p)
@@ -1,5 +1,8 @@
 import ast
+import asyncio
 import inspect
+from concurrent.futures import Executor
+from typing import Optional
 
 from langchain.schema.language_model import BaseLanguageModel
 
@@ -70,22 +73,42 @@ class LMP(LMPBase):
         prompt, use_query = self.build_prompt(query, context=context)
 
         print('', '=' * 20, prompt, '=' * 20, '', sep='\n\n')
-        code_str = self.llm.predict(
-            text=prompt,
-            stop=self._stop_tokens,
-            temperature=self._cfg['temperature'],
-            max_tokens=self._cfg['max_tokens']
-        ).strip()
+        code_str = self.llm.predict(text=prompt, **self._llm_kwargs()).strip()
         code_str = self._post_process_model_output(code_str)
 
+        print('output:', code_str)
+        self._lmp_fgen.create_new_fs_from_code(code_str)
+
+        return self._execute(code_str, context, use_query)
+
+    async def acall(self, query, context=None, executor: Optional[Executor] = None):
+        """
+        Like __call__, but awaits the LLM calls. Context functions, prompt building (which may include embedding
+        lookups) and the generated code run in the executor, since they may block.
+        """
+        loop = asyncio.get_running_loop()
+        if context is None:
+            context = await loop.run_in_executor(executor, self._context_provider)
+        prompt, use_query = await loop.run_in_executor(executor, self.build_prompt, query, context)
+
+        print('', '=' * 20, prompt, '=' * 20, '', sep='\n\n')
+        code_str = (await self.llm.apredict(text=prompt, **self._llm_kwargs())).strip()
+        code_str = self._post_process_model_output(code_str)
+
+        print('output:', code_str)
+        await self._lmp_fgen.acreate_new_fs_from_code(code_str, executor)
+
+        return await loop.run_in_executor(executor, self._execute, code_str, context, use_query)
+
+    def _llm_kwargs(self):
+        return dict(stop=self._stop_tokens, temperature=self._cfg['temperature'], max_tokens=self._cfg['max_tokens'])
+
+    def _execute(self, code_str, context, use_query):
         if self._cfg['include_context'] and context != '':
             to_exec = f'{context}\n{code_str}'
         else:
             to_exec = code_str
 
-        print('output:', code_str)
-        self._lmp_fgen.create_new_fs_from_code(code_str)
-
         return_val_name = self._cfg.get('return_val_name')
         return_val = self.code_execution_env(to_exec, return_val_name=return_val_name)
 
@@ -0,0 +1,328 @@
+import atexit
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Tuple, Dict, Optional, Union, Collection
+
+import numpy as np
+
+from .prompt_journal import PromptJournal, HitBuffer
+from .util import text_key
+
+_DTYPE = np.dtype('<f4')
+
+
+class MemoryStore:
+    """
+    Learned examples shared by several processes (e.g. the REPLs of a robot fleet), in a SQLite database in WAL mode,
+    so that readers never block the writer. Examples are grouped into collections (one per LMP), and readers pick up
+    the examples added (and removed) since their last read by rowid (see MemoryCollection).
+
+    The database also holds the embeddings of example keys as BLOBs, so that each text is only encoded once across
+    all processes (see MemoryStore.embeddings and CachingEncoder), and usage statistics of the examples (how often and
+    when they were last retrieved, see MemoryStore.record_hits).
+    """
+
+    def __init__(self, file: Path) -> None:
+        super().__init__()
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.file, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')  # Durable in WAL mode except on power loss
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS examples (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    collection TEXT NOT NULL,
+                    text TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS examples_by_collection ON examples (collection, id);
+                CREATE TABLE IF NOT EXISTS removals (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    collection TEXT NOT NULL,
+                    example_id INTEGER NOT NULL,
+                    text TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS removals_by_collection ON removals (collection, id);
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, key)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS usage (
+                    collection TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (collection, key)
+                ) WITHOUT ROWID;
+            ''')
+
+    @contextmanager
+    def _transaction(self, write=True):
+        with self._lock:
+            # IMMEDIATE takes the write lock right away, so that reads within the transaction are not outdated.
+            # Read transactions see a consistent snapshot of the database.
+            self._connection.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def add(self, collection: str, texts: List[str]):
+        with self._transaction() as connection:
+            self._insert(connection, collection, texts)
+
+    @staticmethod
+    def _insert(connection: sqlite3.Connection, collection: str, texts: List[str]):
+        connection.executemany('INSERT INTO examples (collection, text) VALUES (?, ?)',
+                               [(collection, t) for t in texts])
+        # Adding counts as use, so that new examples are not evicted before they had a chance to be retrieved
+        now = time.time()
+        connection.executemany(
+            'INSERT INTO usage (collection, key, last_used) VALUES (?, ?, ?) '
+            'ON CONFLICT (collection, key) DO UPDATE SET last_used = MAX(last_used, excluded.last_used)',
+            [(collection, text_key(t), now) for t in texts]
+        )
+
+    def add_if_empty(self, collection: str, texts: List[str]) -> bool:
+        """Atomically initialize an empty collection, returns whether it was empty"""
+        with self._transaction() as connection:
+            empty = connection.execute('SELECT 1 FROM examples WHERE collection = ? LIMIT 1',
+                                       (collection,)).fetchone() is None
+            if empty:
+                self._insert(connection, collection, texts)
+        return empty
+
+    def remove(self, collection: str, text: str) -> bool:
+        """Remove the oldest example with the given text, returns whether there was one"""
+        with self._transaction() as connection:
+            row = connection.execute('SELECT MIN(id) FROM examples WHERE collection = ? AND text = ?',
+                                     (collection, text)).fetchone()
+            if row[0] is None:
+                return False
+            connection.execute('DELETE FROM examples WHERE id = ?', row)
+            connection.execute('INSERT INTO removals (collection, example_id, text) VALUES (?, ?, ?)',
+                               (collection, row[0], text))
+            if connection.execute('SELECT 1 FROM examples WHERE collection = ? AND text = ? LIMIT 1',
+                                  (collection, text)).fetchone() is None:
+                connection.execute('DELETE FROM usage WHERE collection = ? AND key = ?', (collection, text_key(text)))
+        return True
+
+    def record_hits(self, collection: str, hits: Dict[str, Tuple[int, float]]):
+        """Add retrievals of examples, given as (number of retrievals, last retrieval timestamp) by text_key"""
+        with self._transaction() as connection:
+            connection.executemany(
+                'INSERT INTO usage (collection, key, hits, last_used) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (collection, key) DO UPDATE SET '
+                'hits = hits + excluded.hits, last_used = MAX(last_used, excluded.last_used)',
+                [(collection, key, num_hits, last_used) for key, (num_hits, last_used) in hits.items()]
+            )
+
+    def usage(self, collection: str) -> Dict[str, Tuple[int, float]]:
+        """:return: (retrieval hits, last used timestamp) by text_key of the examples"""
+        with self._lock:
+            rows = self._connection.execute('SELECT key, hits, last_used FROM usage WHERE collection = ?',
+                                            (collection,)).fetchall()
+        return {key: (hits, last_used) for key, hits, last_used in rows}
+
+    def changes_after(self, collection: str, rowid: int, removal_id: int
+                      ) -> Tuple[List[Tuple[int, int, str]], List[Tuple[int, str]]]:
+        """
+        :return: the removals (id, example_id, text) after removal_id, and the examples (id, text) after rowid
+        """
+        with self._transaction(write=False) as connection:
+            removals = connection.execute(
+                'SELECT id, example_id, text FROM removals WHERE collection = ? AND id > ? ORDER BY id',
+                (collection, removal_id)
+            ).fetchall()
+            examples = connection.execute(
+                'SELECT id, text FROM examples WHERE collection = ? AND id > ? ORDER BY id', (collection, rowid)
+            ).fetchall()
+        return removals, examples
+
+    def embeddings(self, model_name: str, dimension: int) -> '_EmbeddingTable':
+        return _EmbeddingTable(self, model_name, dimension)
+
+
+class _EmbeddingTable:
+    """Embeddings of one model in a MemoryStore, with the interface of lmp.embedding_store.EmbeddingStore"""
+
+    _MAX_QUERY_PARAMS = 500
+
+    def __init__(self, memory_store: MemoryStore, model_name: str, dimension: int) -> None:
+        super().__init__()
+        self._memory_store = memory_store
+        self.model_name = model_name
+        self.dimension = dimension
+
+    def get(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        """
+        :return: the embeddings of the given texts, and the indices of the texts that are not stored
+            (their rows are left uninitialized)
+        """
+        keys = [text_key(t) for t in texts]
+        found: Dict[str, bytes] = {}
+        store = self._memory_store
+        with store._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), self._MAX_QUERY_PARAMS):
+                chunk = unique_keys[i:i + self._MAX_QUERY_PARAMS]
+                found.update(store._connection.execute(
+                    f'SELECT key, embedding FROM embeddings WHERE model = ? AND key IN ({",".join("?" * len(chunk))})',
+                    [self.model_name] + chunk
+                ).fetchall())
+        result = np.empty((len(texts), self.dimension), dtype=_DTYPE)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in found:
+                result[i] = np.frombuffer(found[key], dtype=_DTYPE)
+            else:
+                missing.append(i)
+        return result, missing
+
+    def add(self, texts: List[str], embeddings: np.ndarray):
+        embeddings = np.asarray(embeddings, dtype=_DTYPE)
+        with self._memory_store._transaction() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO embeddings (model, key, embedding) VALUES (?, ?, ?)',
+                [(self.model_name, text_key(t), e.tobytes()) for t, e in zip(texts, embeddings)]
+            )
+
+
+class MemoryCollection:
+    """
+    The learned prompts of one LMP in a MemoryStore. Like PromptJournal, the prompts are read once with load(), and
+    fetch_changes() returns the prompts removed and added since then, by this or any other process.
+    Additions are returned in the same order everywhere. Retrieval hits are written in batches, like in PromptJournal.
+    """
+
+    def __init__(self, memory_store: MemoryStore, name: str, flush_hits_every=50) -> None:
+        super().__init__()
+        self.memory_store = memory_store
+        self.name = name
+        self._last_rowid = 0
+        self._last_removal_id = 0
+        self._pending_hits = HitBuffer(flush_hits_every)
+        atexit.register(self.flush_hits)
+
+    def __str__(self):
+        return f'{self.memory_store.file} ({self.name})'
+
+    def load(self) -> List[str]:
+        self._last_rowid = 0
+        self._last_removal_id = 0
+        return self.fetch_changes()[1]
+
+    def fetch_changes(self) -> Tuple[List[str], List[str]]:
+        """
+        :return: the removed prompts (to be removed before adding), and the added prompts
+        """
+        removals, examples = self.memory_store.changes_after(self.name, self._last_rowid, self._last_removal_id)
+        # Examples removed before they were read are neither returned as added nor as removed
+        removed = [text for _, example_id, text in removals if example_id <= self._last_rowid]
+        if removals:
+            self._last_removal_id = removals[-1][0]
+        if examples:
+            self._last_rowid = examples[-1][0]
+        return removed, [text for _, text in examples]
+
+    def append(self, prompt: str):
+        """The prompt is returned by the next fetch_changes(), after all prompts added before it"""
+        self.flush_hits()
+        self.memory_store.add(self.name, [prompt])
+
+    def remove(self, prompt: str):
+        """Remove one occurrence of the prompt, which is then returned by the next fetch_changes()"""
+        self.flush_hits()  # Before the removal drops the usage of the prompt
+        self.memory_store.remove(self.name, prompt)
+
+    def record_hits(self, prompts: List[str]):
+        """Count a retrieval of each of the given prompts, written to the store later (see flush_hits)"""
+        if self._pending_hits.add(prompts, time.time()):
+            self.flush_hits()
+
+    def flush_hits(self):
+        """Write the hits recorded since the last flush, in one transaction"""
+        hits = self._pending_hits.take()
+        if hits:
+            self.memory_store.record_hits(self.name, hits)
+
+    def usage(self) -> Dict[str, Tuple[int, float]]:
+        """
+        :return: (retrieval hits, last used timestamp) by text_key of the prompts, as written by all processes plus the
+            hits recorded by this process that are not written yet
+        """
+        usage = self.memory_store.usage(self.name)
+        for key, (hits, last_used) in self._pending_hits.pending().items():
+            written_hits, written_last_used = usage.get(key, (0, last_used))
+            usage[key] = (written_hits + hits, max(written_last_used, last_used))
+        return usage
+
+
+_stores: Dict[Path, MemoryStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_memory_store(file: Path) -> MemoryStore:
+    """Stores (i.e. connections) are shared within the process"""
+    file = Path(file).resolve()
+    with _stores_lock:
+        if file not in _stores:
+            _stores[file] = MemoryStore(file)
+        return _stores[file]
+
+
+def open_custom_prompt_storage(custom_prompt_db_file: Path = None, memory_db: Path = None,
+                               memory_collection: str = None) -> Optional[Union[PromptJournal, MemoryCollection]]:
+    """
+    Storage for the learned prompts of an LMP: the collection memory_collection in the shared memory_db if given,
+    else a PromptJournal in custom_prompt_db_file (if given). An empty collection is initialized with the prompts from
+    custom_prompt_db_file.
+    """
+    if not memory_db:
+        return PromptJournal(custom_prompt_db_file) if custom_prompt_db_file else None
+    if memory_collection is None:
+        if custom_prompt_db_file is None:
+            raise ValueError('memory_collection is required if there is no custom_prompt_db_file')
+        memory_collection = Path(custom_prompt_db_file).name.split('.')[0]
+    collection = MemoryCollection(get_memory_store(memory_db), memory_collection)
+    if custom_prompt_db_file:
+        prompts = PromptJournal(custom_prompt_db_file).load()
+        if prompts and collection.memory_store.add_if_empty(collection.name, prompts):
+            print('Imported', len(prompts), 'prompts from', custom_prompt_db_file, 'into', memory_db)
+    return collection
+
+
+EVICTION_POLICIES = ('lfu', 'lru')
+
+
+def select_for_eviction(prompts: List[str], usage: Dict[str, Tuple[int, float]], capacity: int, policy='lfu',
+                        keep: Collection[str] = ()) -> List[str]:
+    """
+    Choose the learned prompts to remove so that at most capacity remain
+    :param usage: (retrieval hits, last used timestamp) by text_key, see MemoryCollection.usage / PromptJournal.usage
+    :param policy: lfu evicts the least frequently retrieved prompts first (the least recently used among equally
+        frequent ones), lru the least recently used ones
+    :param keep: prompts that must not be evicted, e.g. the one that was just learned
+    """
+    if policy not in EVICTION_POLICIES:
+        raise ValueError(f'Unknown eviction policy {policy}, expected one of {EVICTION_POLICIES}')
+    num_evict = len(prompts) - capacity
+    if num_evict <= 0:
+        return []
+
+    def rank(i: int):
+        hits, last_used = usage.get(text_key(prompts[i]), (0, 0))
+        # Ties (e.g. prompts without usage records) are broken by age, oldest first
+        return (hits, last_used, i) if policy == 'lfu' else (last_used, i)
+
+    candidates = sorted((i for i, p in enumerate(prompts) if p not in keep), key=rank)
+    return [prompts[i] for i in candidates[:num_evict]]
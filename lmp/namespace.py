@@ -21,13 +21,82 @@ def comment(c: str):
     return _apply
 
 
+class VersionedDict(dict):
+    """A dict that counts its modifications, so that caches derived from it can be invalidated cheaply."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def _modified(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._modified()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._modified()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._modified()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._modified()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self._modified()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._modified()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._modified()
+
+
 class DynamicNamespaceDict(dict):
+    _EXCLUDED_GLOBALS = frozenset({'exec', 'eval', '__builtins__'})
 
     def __init__(self, api) -> None:
         super().__init__()
+        self._api_version = 0
         self.api = api
-        self.permanent_definitions = {}  # Dynamically defined (e.g. functions, nested LMPs). part of import_statement
-        self.predefined_globals = {}  # Something like numpy. Not part of import_statement but available in namespace
+        # Dynamically defined (e.g. functions, nested LMPs). part of import_statement
+        self.permanent_definitions = VersionedDict()
+        # Something like numpy. Not part of import_statement but available in namespace
+        self.predefined_globals = VersionedDict()
+        self._base_layer = None  # Never modified in place, replaced on change
+        self._base_layer_version = None
+        self._import_statement_cache = {}
+        self._import_statement_cache_version = None
+        self._import_names = None
+        self._function_def_cache = {}  # name -> (defined object, rendered definition)
+
+    @property
+    def api(self):
+        return self._api
+
+    @api.setter
+    def api(self, api):
+        self._api = api
+        self.invalidate_api()
+
+    def invalidate_api(self):
+        """Call this if the set of attributes exposed by the API object has changed."""
+        self._api_version += 1
+        self._function_def_cache = {}
+
+    @property
+    def definitions_version(self):
+        """Changes whenever the API or the permanent definitions (and thus the import statement) might change"""
+        return self._api_version, self.permanent_definitions.version
 
     def __missing__(self, key):
         if key in self.predefined_globals:
@@ -36,24 +105,39 @@ class DynamicNamespaceDict(dict):
             return self.permanent_definitions[key]
         return getattr(self.api, key)
 
+    def _public_api_names(self):
+        return set(k for k in dir(self.api) if not ('__' in k or k.startswith('_')))
+
     def build_import_statement(self, use_defs=False, line_separator='\n', exclude=()):
-        names_to_import = (self.permanent_definitions.keys() | set(k for k in dir(self.api)
-                                                                   if not ('__' in k or k.startswith('_')))
-                           ) - {'exec', 'eval'} - set(exclude)
-        names_to_import = sorted(names_to_import)  # For deterministic prompts
+        version = self.definitions_version
+        if self._import_statement_cache_version != version:
+            self._import_statement_cache.clear()
+            self._import_statement_cache_version = version
+            self._import_names = None
+        names_to_import = self._import_names
+        if names_to_import is None:
+            names_to_import = self._import_names = (self.permanent_definitions.keys() | self._public_api_names()
+                                                    ) - {'exec', 'eval'}
+        if self.keys() & names_to_import:
+            # A local shadows an imported name. This is rare, so just don't cache it.
+            return self._render_import_statement(names_to_import, use_defs, line_separator, exclude)
+        key = (use_defs, line_separator, tuple(exclude))
+        import_statement = self._import_statement_cache.get(key)
+        if import_statement is None:
+            import_statement = self._render_import_statement(names_to_import, use_defs, line_separator, exclude)
+            self._import_statement_cache[key] = import_statement
+        return import_statement
+
+    def _render_import_statement(self, names_to_import, use_defs, line_separator, exclude):
+        names_to_import = sorted(names_to_import - set(exclude))  # For deterministic prompts
         if names_to_import:
             if use_defs:
                 imports = []
                 function_defs = []
                 for n in names_to_import:
-                    v = self[n]
-                    if callable(v):
-                        s: inspect.Signature = inspect.signature(v)
-                        if hasattr(v, '__prompt_comment__'):
-                            comment = ' # ' + v.__prompt_comment__
-                        else:
-                            comment = ''
-                        function_defs.append(n + str(s).replace('numpy', 'np') + comment)
+                    function_def = self._function_def(n)
+                    if function_def is not None:
+                        function_defs.append(function_def)
                     else:
                         imports.append(n)
                 import_str = (f'from utils import {", ".join(imports)}' + line_separator) if imports else ''
@@ -63,12 +147,45 @@ class DynamicNamespaceDict(dict):
         else:
             return ''
 
+    def _function_def(self, name):
+        """The rendered definition for a callable, or None if the name should be imported as plain value"""
+        v = self[name]
+        identity = getattr(v, '__func__', v)  # API methods are bound again on every access
+        cached = self._function_def_cache.get(name)
+        if cached is not None and cached[0] is identity:
+            return cached[1]
+        if callable(v):
+            s: inspect.Signature = inspect.signature(v)
+            if hasattr(v, '__prompt_comment__'):
+                comment = ' # ' + v.__prompt_comment__
+            else:
+                comment = ''
+            function_def = name + str(s).replace('numpy', 'np') + comment
+        else:
+            function_def = None
+        self._function_def_cache[name] = (identity, function_def)
+        return function_def
+
+    def _build_base_layer(self):
+        """
+        Everything which is not a local: API attributes, permanent definitions and predefined globals
+        (in increasing priority, mirroring __missing__).
+        Rebuilt only if one of these has changed since the last call.
+        """
+        version = (self._api_version, self.permanent_definitions.version, self.predefined_globals.version)
+        if self._base_layer is None or self._base_layer_version != version:
+            base = {k: getattr(self.api, k) for k in self._public_api_names()}
+            base.update(self.permanent_definitions)
+            base.update(self.predefined_globals)
+            for k in self._EXCLUDED_GLOBALS:
+                base.pop(k, None)
+            self._base_layer = base
+            self._base_layer_version = version
+        return self._base_layer
+
     def build_globals_dict(self):
-        names = (self.keys()
-                 | set(k for k in dir(self.api) if not ('__' in k or k.startswith('_')))
-                 | self.permanent_definitions.keys()
-                 | self.predefined_globals.keys()) - {'exec', 'eval', '__builtins__'}
-        return {
-            n: self[n]
-            for n in names
-        }
+        globals_dict = dict(self._build_base_layer())
+        globals_dict.update(self)  # Locals have precedence
+        for k in self._EXCLUDED_GLOBALS & self.keys():
+            del globals_dict[k]
+        return globals_dict
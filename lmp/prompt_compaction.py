@@ -0,0 +1,96 @@
+import ast
+import re
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import astunparse
+import torch
+
+from .embedding_models import SharedEmbeddingModel
+from .embedding_store import CachingEncoder
+
+
+def normalize_code(prompt: str) -> str:
+    """
+    The code of a prompt, without comments, outputs and formatting. For REPL transcripts, only the ">>>" / "..."
+    lines are code, everything else is considered code.
+    """
+    lines = prompt.splitlines()
+    if any(line.startswith('>>>') for line in lines):
+        lines = [line[4:] for line in lines if line.startswith('>>>') or line.startswith('...')]
+    code = '\n'.join(lines)
+    try:
+        return astunparse.unparse(ast.parse(code)).strip()
+    except SyntaxError:
+        code = re.sub(r'#.*', '', code)
+        return re.sub(r'\s+', ' ', code).strip()
+
+
+class NearDuplicateDetector:
+    """
+    Clusters prompts with the same normalized code (see normalize_code) and similar signatures, i.e. the texts they are
+    retrieved by (e.g. the user responses of a transcript). The first prompt of each cluster is its canonical
+    representative, later ones are duplicates.
+
+    Signatures are only encoded for prompts whose code matches that of an earlier one, so that checking a new prompt
+    usually costs a dict lookup.
+    """
+
+    def __init__(self, sim_model: Union[SharedEmbeddingModel, CachingEncoder], signature_fn: Callable[[str], str],
+                 threshold=0.95) -> None:
+        """
+        :param threshold: minimum cosine similarity of the signature embeddings for prompts to be duplicates
+        """
+        super().__init__()
+        self.sim_model = sim_model
+        self.signature_fn = signature_fn
+        self.threshold = threshold
+        # Canonical prompts by normalized code, with their signature embeddings (encoded lazily)
+        self._canonical: Dict[str, List[Tuple[str, Optional[torch.Tensor]]]] = {}
+
+    def _encode(self, prompt: str) -> torch.Tensor:
+        embedding = self.sim_model.encode([self.signature_fn(prompt)], convert_to_tensor=True)[0]
+        return torch.nn.functional.normalize(embedding, dim=-1)
+
+    def find_duplicate(self, prompt: str) -> Optional[str]:
+        """:return: the canonical prompt that the given prompt duplicates, if any"""
+        candidates = self._canonical.get(normalize_code(prompt))
+        if not candidates:
+            return None
+        embedding = self._encode(prompt)
+        for i, (canonical, canonical_embedding) in enumerate(candidates):
+            if canonical_embedding is None:
+                canonical_embedding = self._encode(canonical)
+                candidates[i] = (canonical, canonical_embedding)
+            if torch.dot(embedding, canonical_embedding.to(embedding.device)) >= self.threshold:
+                return canonical
+        return None
+
+    def add(self, prompt: str) -> Optional[str]:
+        """
+        Add the prompt as canonical, unless it is a duplicate
+        :return: the canonical prompt that the given prompt duplicates, if any
+        """
+        duplicate_of = self.find_duplicate(prompt)
+        if duplicate_of is None:
+            self._canonical.setdefault(normalize_code(prompt), []).append((prompt, None))
+        return duplicate_of
+
+    def remove(self, prompt: str):
+        candidates = self._canonical.get(normalize_code(prompt), [])
+        for i, (canonical, _) in enumerate(candidates):
+            if canonical == prompt:
+                del candidates[i]
+                return
+
+
+def find_near_duplicates(prompts: List[str], detector: NearDuplicateDetector) -> List[Tuple[str, str]]:
+    """
+    Offline compaction: cluster the prompts (in order, so that the oldest prompt of each cluster is kept)
+    :return: (duplicate, canonical prompt) for each prompt that should be removed
+    """
+    duplicates = []
+    for prompt in prompts:
+        duplicate_of = detector.add(prompt)
+        if duplicate_of is not None:
+            duplicates.append((prompt, duplicate_of))
+    return duplicates
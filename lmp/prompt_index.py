@@ -0,0 +1,147 @@
+from typing import List, Tuple, Optional, Union, Dict, Iterable, Set
+
+import torch
+
+from .embedding_models import SharedEmbeddingModel
+from .embedding_store import CachingEncoder
+from .vector_search import VectorSearch, GrowingTensor, create_vector_search
+
+
+class PromptIndex:
+    """
+    Embeddings for a prompt database. Each prompt has one or more keys (texts to embed, e.g. the user responses
+    contained in the prompt), each key is one row of the embedding matrix.
+
+    Rows are partitioned by key type, so that retrieval restricted to some types only touches their rows.
+    The index is append-only: adding prompts only encodes their own keys, and rows are written into buffers that
+    grow geometrically, so that the matrices are extended in place.
+
+    Each partition is searched with a VectorSearch created from retrieval_cfg (see create_vector_search),
+    i.e. exactly by default, or approximately for large databases.
+
+    Removed prompts are only skipped by search, until they make up most of the index, which is then rebuilt (i.e. the
+    keys of the remaining prompts are encoded again). Prompt indices are therefore only valid until the next remove.
+    """
+
+    def __init__(self, sim_model: Union[SharedEmbeddingModel, CachingEncoder], retrieval_cfg: Dict = None) -> None:
+        super().__init__()
+        self.sim_model = sim_model
+        self.retrieval_cfg = retrieval_cfg
+        self.prompts: List[str] = []
+        self._keys: List[List[Tuple[str, Optional[str]]]] = []
+        self._removed: Set[int] = set()
+        self._partitions: Dict[Optional[str], _Partition] = {}
+
+    def __len__(self):
+        return len(self.prompts) - len(self._removed)
+
+    @property
+    def num_rows(self):
+        return sum(len(p) for p in self._partitions.values())
+
+    @property
+    def nbytes(self):
+        """Memory used by the embeddings"""
+        return sum(p.search.nbytes for p in self._partitions.values())
+
+    def add(self, prompts_with_keys: List[Tuple[str, List[Tuple[str, Optional[str]]]]]):
+        """
+        :param prompts_with_keys: prompts, each with its list of (key text, key type)
+        """
+        texts = []
+        prompt_indices = []
+        key_types = []
+        for prompt, keys in prompts_with_keys:
+            prompt_idx = len(self.prompts)
+            self.prompts.append(prompt)
+            self._keys.append(keys)
+            for text, key_type in keys:
+                texts.append(text)
+                prompt_indices.append(prompt_idx)
+                key_types.append(key_type)
+        if not texts:
+            return
+        embeddings = torch.nn.functional.normalize(self.sim_model.encode(texts, convert_to_tensor=True), dim=-1)
+        for key_type in dict.fromkeys(key_types):
+            rows = [i for i, t in enumerate(key_types) if t == key_type]
+            if key_type not in self._partitions:
+                self._partitions[key_type] = _Partition(create_vector_search(self.retrieval_cfg))
+            self._partitions[key_type].append(
+                embeddings[rows], torch.tensor([prompt_indices[i] for i in rows], device=embeddings.device))
+
+    def remove(self, prompt: str) -> bool:
+        """Remove the most recently added occurrence of the prompt, returns whether there was one"""
+        for i in range(len(self.prompts) - 1, -1, -1):
+            if self.prompts[i] == prompt and i not in self._removed:
+                self._removed.add(i)
+                if len(self._removed) > max(len(self), 64):
+                    self._rebuild()
+                return True
+        return False
+
+    def _rebuild(self):
+        remaining = [(p, k) for i, (p, k) in enumerate(zip(self.prompts, self._keys)) if i not in self._removed]
+        self.prompts = []
+        self._keys = []
+        self._removed = set()
+        self._partitions = {}
+        self.add(remaining)
+
+    def search(self, query: torch.Tensor, top_k: int, types: Iterable[Optional[str]] = None) -> List[int]:
+        """
+        :param query: query embedding
+        :param types: only consider keys of these types. All keys, if None.
+        :return: indices of the top_k prompts with the most similar keys (by cosine similarity), most similar first.
+            Prompts with identical text are only returned once.
+        """
+        partitions = [self._partitions[t] for t in (self._partitions if types is None else types)
+                      if t in self._partitions and len(self._partitions[t])]
+        if not partitions or top_k <= 0:
+            return []
+        query = torch.nn.functional.normalize(query.reshape(-1), dim=0)
+
+        # Take the top candidates of each partition, and only look further if they contain too many duplicates
+        num_candidates = top_k
+        while True:
+            similarities = []
+            prompt_indices = []
+            exhausted = True
+            for p in partitions:
+                values, rows = p.search.search(query, num_candidates)
+                similarities.append(values)
+                prompt_indices.append(p.prompt_indices[rows])
+                exhausted &= len(rows) < num_candidates
+            similarities = torch.cat(similarities)
+            candidates = torch.topk(similarities, min(num_candidates, len(similarities))).indices  # sorted
+            result = []
+            seen = set()
+            for prompt_idx in torch.cat(prompt_indices)[candidates].tolist():
+                prompt = self.prompts[prompt_idx]
+                if prompt not in seen and prompt_idx not in self._removed:
+                    seen.add(prompt)
+                    result.append(prompt_idx)
+                    if len(result) == top_k:
+                        return result
+            if exhausted:
+                return result
+            num_candidates *= 2
+
+
+class _Partition:
+    """Search over the normalized embeddings of the keys of one type, with the index of their prompts"""
+
+    def __init__(self, search: VectorSearch) -> None:
+        super().__init__()
+        self.search = search
+        self._prompt_indices = GrowingTensor()
+
+    def __len__(self):
+        return len(self._prompt_indices)
+
+    @property
+    def prompt_indices(self) -> torch.Tensor:
+        return self._prompt_indices.tensor
+
+    def append(self, embeddings: torch.Tensor, prompt_indices: torch.Tensor):
+        self.search.add(embeddings)
+        self._prompt_indices.append(prompt_indices)
@@ -0,0 +1,263 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Iterator, Tuple, Dict, Optional, Deque, Sequence
+
+from .util import text_key
+
+
+def _count_use(usage: Dict[str, List], key: str, hits: int, timestamp: float):
+    entry = usage.setdefault(key, [0, timestamp])
+    entry[0] += hits
+    entry[1] = max(entry[1], timestamp)
+
+
+class HitBuffer:
+    """
+    Retrieval hits of learned prompts, counted in memory and written in batches: prompts are retrieved for every
+    generated statement, writing each retrieval would cost disk I/O (and a lock shared by all processes) every time.
+    """
+
+    def __init__(self, flush_every: int) -> None:
+        """:param flush_every: number of add() calls after which the hits should be written"""
+        super().__init__()
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._hits: Dict[str, List] = {}  # text_key -> [hits, last used]
+        self._num_rounds = 0
+
+    def __bool__(self):
+        return bool(self._hits)
+
+    def add(self, prompts: Sequence[str], timestamp: float) -> bool:
+        """:return: whether flush_every calls are pending, i.e. whether the hits should be written now"""
+        with self._lock:
+            for p in prompts:
+                _count_use(self._hits, text_key(p), 1, timestamp)
+            self._num_rounds += 1
+            return self._num_rounds >= self.flush_every
+
+    def pending(self) -> Dict[str, Tuple[int, float]]:
+        """:return: (hits, last used timestamp) by text_key, not written yet"""
+        with self._lock:
+            return {key: tuple(u) for key, u in self._hits.items()}
+
+    def take(self) -> Dict[str, Tuple[int, float]]:
+        """:return: like pending(), which is then empty, i.e. the caller is responsible for writing the hits"""
+        with self._lock:
+            hits, self._hits = self._hits, {}
+            self._num_rounds = 0
+        return {key: tuple(u) for key, u in hits.items()}
+
+
+class PromptJournal:
+    """
+    Append-only storage for a list of learned prompts, as a JSONL file of {"add": prompt} / {"remove": prompt}
+    records. Appends are fsync'd, so that a learning event costs O(1) I/O and a crash can at most lose the record
+    that was being written (an incomplete last line is dropped on load).
+
+    Retrievals of prompts are counted in memory (see usage()) and written as (not fsync'd) {"hits": {text_key: [hits,
+    last used], ...}} records every flush_hits_every calls of record_hits(), before learning or removing a prompt, and
+    by flush_hits(), which also runs at exit.
+
+    The journal is compacted (rewritten with one "add" per live prompt, including its usage) once it contains more
+    obsolete records than live prompts. A legacy JSON list file (custom_prompt_db_file of earlier versions) is migrated
+    on first use, i.e. if there is no journal next to it yet. It is left in place, but no longer read.
+
+    The prompts are read once with load(), fetch_changes() returns the prompts removed and appended since then
+    (by this process only, see lmp.memory_store.MemoryCollection for sharing between processes).
+    """
+
+    def __init__(self, file: Path, compact_min_obsolete_records=100, flush_hits_every=50) -> None:
+        """
+        :param file: the journal (.jsonl) or the legacy JSON file, which is then migrated to the .jsonl file next to it
+        """
+        super().__init__()
+        file = Path(file)
+        self.file = file.with_suffix('.jsonl')
+        self.compact_min_obsolete_records = compact_min_obsolete_records
+        self._lock_file = file.with_suffix('.jsonl.lock')
+        self._lock = threading.Lock()
+        self._num_records = 0
+        self._num_live = 0
+        self._new: List[str] = []
+        self._removed: List[str] = []
+        self._usage: Dict[str, List] = {}  # text_key -> [hits, last used], including the pending hits
+        self._pending_hits = HitBuffer(flush_hits_every)
+        atexit.register(self.flush_hits)
+        legacy_file = file.with_suffix('.json')
+        if not self.file.exists() and legacy_file.exists():
+            with self._locked():
+                if self.file.exists():  # Migrated by another process meanwhile
+                    return
+                prompts = json.loads(legacy_file.read_text())
+                print('Migrating', len(prompts), 'prompts from', legacy_file, 'to', self.file)
+                self._rewrite(prompts)
+                print(legacy_file, 'is not read anymore, prompts are learned in', self.file)
+
+    def __str__(self):
+        return str(self.file)
+
+    @contextmanager
+    def _locked(self):
+        """Thread and process lock. Compaction replaces the journal file, so a separate lock file is used."""
+        with self._lock, self._lock_file.open('a') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)  # Released when the file is closed
+            yield
+
+    def load(self) -> List[str]:
+        self._new = []
+        self._removed = []
+        if not self.file.exists():
+            return []
+        with self._locked():
+            prompts = self._replay()
+            if self._needs_compaction():
+                self._rewrite(prompts)
+        return prompts
+
+    def _needs_compaction(self):
+        return self._num_records - self._num_live >= max(self._num_live, self.compact_min_obsolete_records)
+
+    def fetch_changes(self) -> Tuple[List[str], List[str]]:
+        """
+        :return: the removed prompts (to be removed before adding), and the added prompts
+        """
+        changes = self._removed, self._new
+        self._removed, self._new = [], []
+        return changes
+
+    def usage(self) -> Dict[str, Tuple[int, float]]:
+        """
+        :return: (retrieval hits, last used timestamp) by text_key of the prompts, as of load() plus the hits recorded
+            by this process since then (whether written yet or not)
+        """
+        return {key: tuple(u) for key, u in self._usage.items()}
+
+    def append(self, prompt: str):
+        self.flush_hits()
+        now = time.time()
+        self._write_record({'add': prompt, 't': now}, live_delta=1)
+        self._new.append(prompt)
+        _count_use(self._usage, text_key(prompt), 0, now)
+
+    def record_hits(self, prompts: List[str]):
+        """Count a retrieval of each of the given prompts, written to the journal later (see flush_hits)"""
+        now = time.time()
+        with self._lock:
+            for p in prompts:
+                _count_use(self._usage, text_key(p), 1, now)
+            flush = self._pending_hits.add(prompts, now)
+        if flush:
+            self.flush_hits()
+
+    def flush_hits(self):
+        """Write the hits recorded since the last flush, as one record"""
+        if not self._pending_hits:
+            return
+        with self._locked():
+            hits = self._pending_hits.take()
+            if hits:
+                # Losing some usage statistics in a crash is acceptable, no need to wait for the disk
+                self._append_record({'hits': hits}, live_delta=0, sync=False)
+        if self._needs_compaction():
+            self.compact()
+
+    def remove(self, prompt: str):
+        """Remove one occurrence of the given prompt"""
+        self.flush_hits()  # Before the removal drops the usage of the prompt
+        self._write_record({'remove': prompt}, live_delta=-1)
+        if prompt in self._new:
+            self._new.remove(prompt)
+        else:
+            self._removed.append(prompt)
+        if self._needs_compaction():
+            self.compact()
+
+    def compact(self):
+        with self._locked():
+            self._rewrite(self._replay())
+
+    def _write_record(self, record: dict, live_delta: int, sync=True):
+        with self._locked():
+            self._append_record(record, live_delta, sync)
+
+    def _append_record(self, record: dict, live_delta: int, sync: bool):
+        with self.file.open('ab') as f:
+            f.write(json.dumps(record).encode('utf-8') + b'\n')
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._num_records += 1
+        self._num_live += live_delta
+
+    def _read_records(self) -> Iterator[dict]:
+        if not self.file.exists():
+            return
+        with self.file.open('rb') as f:
+            valid_length = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Incomplete write, truncate so that the next record starts on a new line
+                    print('Dropping incomplete record at the end of', self.file)
+                    os.truncate(self.file, valid_length)
+                    return
+                valid_length += len(line)
+                yield json.loads(line)
+
+    def _replay(self) -> List[str]:
+        added: List[Optional[str]] = []  # None where removed
+        live: Dict[str, Deque[int]] = {}  # prompt -> indices in added of its live occurrences, first one first
+        self._num_records = 0
+        self._usage = {}
+        for record in self._read_records():
+            self._num_records += 1
+            if 'add' in record:
+                live.setdefault(record['add'], deque()).append(len(added))
+                added.append(record['add'])
+                # Only compaction writes the hits of a prompt into its "add" record
+                _count_use(self._usage, text_key(record['add']), record.get('hits', 0), record['t'])
+            elif 'hits' in record:
+                for key, (hits, timestamp) in record['hits'].items():
+                    _count_use(self._usage, key, hits, timestamp)
+            elif live.get(record['remove']):
+                occurrences = live[record['remove']]
+                added[occurrences.popleft()] = None  # Like list.remove, the first occurrence
+                if not occurrences:
+                    del live[record['remove']]
+                    self._usage.pop(text_key(record['remove']), None)
+        for key, (hits, timestamp) in self._pending_hits.pending().items():
+            _count_use(self._usage, key, hits, timestamp)
+        prompts = [p for p in added if p is not None]
+        self._num_live = len(prompts)
+        return prompts
+
+    def _rewrite(self, prompts: List[str]):
+        tmp_file = self.file.with_suffix('.jsonl.tmp')
+        now = time.time()
+        written_usage = set()
+        with tmp_file.open('wb') as f:
+            for prompt in prompts:
+                key = text_key(prompt)
+                hits, timestamp = self._usage.get(key, (0, now))  # No usage yet when migrating
+                record = {'add': prompt, 't': timestamp}
+                if hits and key not in written_usage:  # Usage is per text, not per occurrence
+                    record['hits'] = hits
+                    written_usage.add(key)
+                f.write(json.dumps(record).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file)
+        dir_fd = os.open(self.file.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._num_records = self._num_live = len(prompts)
+        self._pending_hits.take()  # Part of the written usage
@@ -0,0 +1,62 @@
+"""
+Compares the top-k prompt selection with quantized embeddings (see lmp.vector_search.QuantizedSearch) against float32,
+on the prompt DB of a REPL config: memory per row, overlap of the top-k with float32, and search latency. Each prefix of
+a prompt that ends with a user response is used as query.
+
+Usage: python -m lmp.quantization_report [config, relative to config/ and without .yaml] [top_k]
+"""
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from lmp.prompt_index import PromptIndex
+from lmp.repl.dynamic_prompt import DynamicPromptBuilder
+from lmp.repl.util import WAIT_FOR_USER_INPUT
+from lmp.setup import load_config
+
+
+def _queries(prompts: List[str]):
+    for p in prompts:
+        for match in WAIT_FOR_USER_INPUT.finditer(p):
+            end_of_response = p.find('\n', match.end() + 1)
+            if end_of_response != -1:
+                yield p[:end_of_response + 1]
+
+
+def main(cfg_path='cap_tabletop/repl_flat_fgen/repl', top_k: int = None, repeats=20):
+    cfg = load_config(Path(__file__).parent.parent / 'config' / f'{cfg_path}.yaml')
+    prompt_cfg = dict(cfg['prompt_cfg'])
+    prompt_cfg.pop('retrieval', None)
+    builder = DynamicPromptBuilder(**prompt_cfg)
+    top_k = top_k or builder.top_k
+    queries = [builder.query_from_exec_history(q) for q in _queries(builder.predefined_prompt_db)]
+    print(len(builder.prompt_db), 'prompts,', len(queries), 'queries, top_k =', top_k, 'embedding model',
+          prompt_cfg.get('sentence_similarity_model', 'all-MiniLM-L6-v2'),
+          f'({builder.sim_model.get_sentence_embedding_dimension()} dimensions)')
+
+    def _top_k(precision: str):
+        index = PromptIndex(builder._prompt_encoder, {'precision': precision})
+        index.add([(p, builder._index_keys(r)) for p, r in builder.prompt_db])
+        index.search(queries[0][1], top_k, queries[0][0])  # Warm-up
+        best_time = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            results = [index.search(feats, top_k, types) for types, feats in queries]
+            best_time = min(best_time, time.perf_counter() - start)
+        return index.nbytes / index.num_rows, results, best_time / len(queries)
+
+    runs = {precision: _top_k(precision) for precision in ('float32', 'float16', 'int8')}
+    reference_bytes, reference, reference_time = runs['float32']
+    print(f'{"precision":>10} {"bytes/row":>10} {"overlap":>8} {"same set":>9} {"same order":>11} {"us/query":>9}')
+    for precision, (bytes_per_row, results, query_time) in runs.items():
+        overlap = sum(len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(reference, results)) / len(queries)
+        same_set = sum(set(a) == set(b) for a, b in zip(reference, results)) / len(queries)
+        same_order = sum(a == b for a, b in zip(reference, results)) / len(queries)
+        print(f'{precision:>10} {bytes_per_row:>10.0f} {overlap:>8.2%} {same_set:>9.2%} {same_order:>11.2%}'
+              f' {query_time * 1e6:>9.0f}  ({reference_bytes / bytes_per_row:.1f}x smaller, '
+              f'{query_time / reference_time:.2f}x the float32 latency)')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2], *[int(k) for k in sys.argv[2:3]])
@@ -1,5 +1,9 @@
+import ast
+from functools import lru_cache
+from typing import Tuple
+
 from .dynamic_prompt import WAIT_FOR_USER_INPUT
-from ..code_execution import CodeExecutionEnvironment
+from ..code_execution import CodeExecutionEnvironment, check_banned_phrases
 
 
 class ReplExecutionEnvironment(CodeExecutionEnvironment):
@@ -16,33 +20,115 @@ class ReplExecutionEnvironment(CodeExecutionEnvironment):
         local_vars = {}
         results = []
 
-        def _eval(c: str):
-            exec_result = self._exec_safe_with_recursion_check(c, eval_mode=True)
-            local_vars.update(exec_result.defined_local_vars)
-            results.append(exec_result.return_value)
-
-        try:
-            _eval(code)
-        except SyntaxError:
-            remaining = code.splitlines()
-            if WAIT_FOR_USER_INPUT.fullmatch(remaining[-1]):  # full match already assures that it's not nested
-                final_line = remaining.pop(-1)
+        check_banned_phrases(code)  # Before executing any part of the code
+        for chunk, eval_mode in _split_interactive(code):
+            if eval_mode:
+                exec_result = self._exec_safe_with_recursion_check(chunk, eval_mode=True)
+                local_vars.update(exec_result.defined_local_vars)
+                results.append(exec_result.return_value)
             else:
-                final_line = None
-            for line in list(remaining):
-                try:
-                    if not line.strip().startswith('#'):
-                        _eval(line)
-                    remaining.pop(0)
-                except SyntaxError:
-                    break
-            super().__call__('\n'.join(remaining), local_vars)
-            if final_line:
-                # A final wait_for_trigger() or ask(...) should always have its result returned visibly
-                _eval(final_line)
+                super().__call__(chunk, local_vars)
 
         # REPL behavior: all local vars set should remain
         for k in local_vars.keys():
             self.namespace[k] = local_vars[k]
 
         return results
+
+
+@lru_cache(maxsize=1024)
+def _split_interactive(code: str) -> Tuple[Tuple[str, bool], ...]:
+    """
+    Split code into (chunk, eval_mode) pairs, mimicking an interactive console:
+    A single expression is evaluated as a whole. Otherwise, leading single-line expression statements (up to the first
+    blank line) are evaluated one by one, the rest is executed as one block, and a final wait_for_trigger() or ask(...)
+    is evaluated last, since its result should always be returned visibly.
+    """
+    try:
+        statements = ast.parse(code).body
+    except SyntaxError:
+        # E.g. indented code, which eval() accepts after stripping the indentation of the first line
+        return _split_by_lines(code)
+    lines = code.splitlines()
+
+    def _alone_on_line(i: int):
+        stmt = statements[i]
+        return (stmt.lineno == stmt.end_lineno
+                and (i == 0 or statements[i - 1].end_lineno < stmt.lineno)
+                and (i == len(statements) - 1 or statements[i + 1].lineno > stmt.lineno)
+                and _is_blank(_rest_of_line(lines, stmt)))
+
+    def _is_line_expression(i: int):
+        return isinstance(statements[i], ast.Expr) and _alone_on_line(i)
+
+    def _follows_leading_lines(i: int):
+        """Whether only comments (no blank lines) are between the statement and the previous one"""
+        previous_end = statements[i - 1].end_lineno if i > 0 else 0
+        return all(_is_comment(x) for x in lines[previous_end:statements[i].lineno - 1])
+
+    if len(statements) == 1 and isinstance(statements[0], ast.Expr) and _is_expression(code):
+        return (code, True),
+
+    chunks = []
+    end = len(statements)
+    final_line = None
+    if statements and _is_line_expression(end - 1) and WAIT_FOR_USER_INPUT.fullmatch(lines[-1]):
+        # full match already assures that it's not nested
+        final_line = lines[-1]
+        end -= 1
+    start = 0
+    while start < end and _is_line_expression(start) and _follows_leading_lines(start):
+        chunks.append((lines[statements[start].lineno - 1], True))
+        start += 1
+    if start < end:
+        stmt = statements[start]
+        first_line = min([stmt.lineno] + [d.lineno for d in getattr(stmt, 'decorator_list', ())])
+        last_line = len(lines) - 1 if final_line is not None else len(lines)
+        chunks.append(('\n'.join(lines[first_line - 1:last_line]), False))
+    if final_line is not None:
+        chunks.append((final_line, True))
+    return tuple(chunks)
+
+
+def _split_by_lines(code: str) -> Tuple[Tuple[str, bool], ...]:
+    """
+    Like _split_interactive, for code that does not parse as a whole: try to evaluate it as a whole, then its leading
+    lines one by one (skipping comments) up to the first one that is not an expression, and execute the rest
+    """
+    if _is_expression(code):
+        return (code, True),
+    remaining = code.splitlines()
+    final_line = remaining.pop(-1) if remaining and WAIT_FOR_USER_INPUT.fullmatch(remaining[-1]) else None
+    chunks = []
+    while remaining and (_is_comment(remaining[0]) or _is_expression(remaining[0])):
+        line = remaining.pop(0)
+        if not _is_comment(line):
+            chunks.append((line, True))
+    if remaining:
+        chunks.append(('\n'.join(remaining), False))
+    if final_line is not None:
+        chunks.append((final_line, True))
+    return tuple(chunks)
+
+
+def _is_expression(code: str):
+    """Whether eval() accepts the code, which ignores leading spaces and tabs"""
+    try:
+        compile(code.lstrip(' \t'), '<string>', 'eval')
+    except SyntaxError:
+        return False
+    return True
+
+
+def _is_comment(line: str):
+    return line.strip().startswith('#')
+
+
+def _rest_of_line(lines, stmt: ast.stmt):
+    return lines[stmt.end_lineno - 1].encode()[stmt.end_col_offset:].decode()  # Offsets are in UTF-8 bytes
+
+
+def _is_blank(line: str):
+    line = line.strip()
+    return line == '' or line.startswith('#')
+
@@ -1,16 +1,18 @@
 import ast
-import json
+import copy
 import re
 import sys
-from functools import cached_property
+import threading
 from pathlib import Path
-from typing import Tuple, List
+from typing import Tuple, List, Sequence, Dict, Optional
 
 import torch
-from sentence_transformers import util, SentenceTransformer
-
-END_OF_TASK = 'wait_for_trigger()'
-WAIT_FOR_USER_INPUT = re.compile(r"ask\(('[^']+'|\"[^\"]+\")\)|" + re.escape(END_OF_TASK))
+from ..embedding_models import get_embedding_model
+from ..embedding_store import DEFAULT_EMBEDDING_CACHE_DIR, create_prompt_encoder
+from ..learned_prompts import LearnedPrompts
+from ..memory_store import open_custom_prompt_storage
+from ..token_count import DEFAULT_TOKENIZER, get_token_counter
+from .util import END_OF_TASK, WAIT_FOR_USER_INPUT, UserResponse, find_user_responses
 
 
 class DynamicPromptBuilder:
@@ -19,16 +21,34 @@ class DynamicPromptBuilder:
     # or {'type': 'dialog', 'text': ...}
     # or {'type': 'action_recognition', 'activity': ..., 'person': ...}
 
+    LAYOUTS = ('similarity', 'stable')
+
     def __init__(self, base_prompt: str,
                  prompt_db: List[str],  # List of all exemplary interactions
                  loop_prevention_prompt: str,
                  prompt_suffix='',
                  prompt_separator='\n',
                  custom_prompt_db_file: str = None,
+                 memory_db: str = None,  # SQLite database to share learned prompts with other processes
+                 memory_collection: str = None,  # Name of the learned prompts in memory_db
                  query_history_importance_decay=0.6,
                  top_k=2,
                  query_keep_last_n=3,
                  sentence_similarity_model='all-MiniLM-L6-v2',
+                 embedding_cache_dir=DEFAULT_EMBEDDING_CACHE_DIR,  # None to disable persistent caching
+                 retrieval: Dict = None,  # See lmp.vector_search.create_vector_search, exact search by default
+                 near_duplicate_threshold: float = None,  # Do not store near-duplicates of learned prompts, e.g. 0.95
+                 capacity: int = None,  # Maximum number of learned prompts (needs a custom_prompt_db_file or memory_db)
+                 eviction='lfu',  # Learned prompts to remove when over capacity: least frequently or recently used
+                 # Maximum number of prompt tokens. Examples (at most top_k) are chosen to fill what is left after the
+                 # base prompt, imports and history (see __call__). None to always use top_k examples
+                 token_budget: int = None,
+                 tokenizer=DEFAULT_TOKENIZER,  # tiktoken encoding or model name, for token_budget
+                 # Examples which are always part of the prompt, right after the base prompt
+                 pinned_prompt_db: List[str] = (),
+                 # Order of the retrieved examples: 'similarity' (most similar last, i.e. next to the history) or
+                 # 'stable' (database order), so that consecutive prompts share longer prefixes for prompt caching
+                 layout='similarity',
                  device='cpu') -> None:
         super().__init__()
         self.base_prompt = base_prompt
@@ -38,18 +58,54 @@ class DynamicPromptBuilder:
         self.query_keep_last_n = query_keep_last_n
         self.query_history_importance_decay = query_history_importance_decay
         self.prompt_separator = prompt_separator
+        self.retrieval_cfg = retrieval
+        if layout not in self.LAYOUTS:
+            raise ValueError(f'Unknown layout {layout}, expected one of {self.LAYOUTS}')
+        self.layout = layout
+        self.pinned_prompt_db = list(pinned_prompt_db)
+        self.token_budget = token_budget
+        self.count_tokens = get_token_counter(tokenizer)
+        # Token counts of the last prompt built with a token_budget, for reporting
+        self.last_token_counts: Dict[str, int] = {}
         self.predefined_prompt_db = prompt_db
         self.custom_prompt_db_file = Path(custom_prompt_db_file) if custom_prompt_db_file else None
         print('No custom prompt db' if self.custom_prompt_db_file is None else self.custom_prompt_db_file.resolve())
-        self.custom_prompt_db = (json.loads(self.custom_prompt_db_file.read_text())
-                                 if custom_prompt_db_file and self.custom_prompt_db_file.exists() else [])
-        self.sim_model = SentenceTransformer(sentence_similarity_model)
-        if device:
-            self.sim_model.to(device)
+        self.sim_model = get_embedding_model(sentence_similarity_model, device or None)
+        self._prompt_encoder = create_prompt_encoder(sentence_similarity_model, device or None, embedding_cache_dir,
+                                                     memory_db)
+        self._learned_prompts = LearnedPrompts(
+            prompt_db, open_custom_prompt_storage(custom_prompt_db_file, memory_db, memory_collection),
+            self._prompt_encoder, self._prompt_index_keys, self.duplicate_signature, retrieval,
+            near_duplicate_threshold, capacity, eviction, kind='interaction')
+        # Parsed and encoded user responses, see _combine_user_responses
+        self._query_cache: Dict[UserResponse, Tuple[dict, torch.Tensor]] = {}
+        self._last_query_window: Tuple[UserResponse, ...] = ()
+        self._last_combined_query = None
+        # Shared with forks, which build prompts concurrently from the same prompt DB, index and learned prompts
+        self._lock = threading.Lock()
+
+    def fork(self) -> 'DynamicPromptBuilder':
+        """
+        A builder for another session (e.g. of lmp.repl_server), sharing the prompt DB with its index, the embedding
+        models and the learned prompts (including those learned in any of the sessions), but with its own query state
+        """
+        with self._lock:
+            # Computed here, so that all forks share them instead of computing their own
+            self._learned_prompts.warm_up()
+            fork = copy.copy(self)
+        fork.last_token_counts = {}
+        fork._query_cache = {}
+        fork._last_query_window = ()
+        fork._last_combined_query = None
+        return fork
+
+    @property
+    def custom_prompt_db(self) -> List[str]:
+        return self._learned_prompts.learned
 
-    @cached_property
+    @property
     def prompt_db(self) -> List[Tuple[str, List[dict]]]:
-        all_prompts: List[str] = self.predefined_prompt_db + self.custom_prompt_db
+        all_prompts: List[str] = self._learned_prompts.prompts
         response_lists: List[List[dict]] = []
         for p in all_prompts:
             response_lists.append(self._extract_responses_from_prompt(p))
@@ -57,35 +113,31 @@ class DynamicPromptBuilder:
 
     @staticmethod
     def _extract_responses_from_prompt(p: str):
-        result = []
-        for match in WAIT_FOR_USER_INPUT.finditer(p):
-            newline_idx = match.end()
-            end_of_result_line = p.find('\n', newline_idx + 1)
-            if end_of_result_line == -1:
-                end_of_result_line = len(p)  # In case there is no trailing newline
-            response = p[newline_idx + 1:end_of_result_line]
-            if response.startswith('>>>') or response.startswith('...'):
-                continue  # The "ask/wait_for_trigger" was part of a compound/control flow statement, ignore
-            if not response.startswith('{'):
-                if response.startswith("'") or response.startswith('"'):
-                    response = response[1:-1]  # Avoid duplicate hyphens
-                response = "{'type': 'dialog', 'text': '" + response + "'}"
-            try:
-                result.append(ast.literal_eval(response))
-            except SyntaxError as e:
-                # Try fixing simple hyphen error:
-                match = re.fullmatch(r"\{\s*'type'\s*:\s*'dialog'\s*,\s*'text'\s*:\s*'(.*)'\s*}", response)
-                if match:
-                    fixed_response = "{'type': 'dialog', 'text': \"" + match.group(1).replace('"', r'\"') + "\"}"
-                    try:
-                        result.append(ast.literal_eval(fixed_response))
-                        continue
-                    except SyntaxError:
-                        pass
-                print('in _extract_responses_from_prompt: Response line not parsable:', str(e), '\n',
-                      response, '\nin prompt:\n', p, file=sys.stderr)
-                raise
-        return result
+        responses, awaiting_response = find_user_responses(p)
+        if awaiting_response:
+            responses.append('')  # There is no trailing newline, so the response is empty
+        return [DynamicPromptBuilder._parse_response(response, p) for response in responses]
+
+    @staticmethod
+    def _parse_response(response: str, p: str) -> dict:
+        if not response.startswith('{'):
+            if response.startswith("'") or response.startswith('"'):
+                response = response[1:-1]  # Avoid duplicate hyphens
+            response = "{'type': 'dialog', 'text': '" + response + "'}"
+        try:
+            return ast.literal_eval(response)
+        except SyntaxError as e:
+            # Try fixing simple hyphen error:
+            match = re.fullmatch(r"\{\s*'type'\s*:\s*'dialog'\s*,\s*'text'\s*:\s*'(.*)'\s*}", response)
+            if match:
+                fixed_response = "{'type': 'dialog', 'text': \"" + match.group(1).replace('"', r'\"') + "\"}"
+                try:
+                    return ast.literal_eval(fixed_response)
+                except SyntaxError:
+                    pass
+            print('in _extract_responses_from_prompt: Response line not parsable:', str(e), '\n',
+                  response, '\nin prompt:\n', p, file=sys.stderr)
+            raise
 
     def _calc_prompt_embeddings_and_idx_map(self, queries: List[List[dict]]) -> Tuple[torch.Tensor, List[int]]:
         if len(queries) == 0:
@@ -96,74 +148,150 @@ class DynamicPromptBuilder:
         for i, responses in enumerate(queries):
             for r in responses:
                 idx_map.append(i)
-                if r['type'] == 'dialog':
-                    flattened.append(r['text'])
-                elif r['type'] == 'action_recognition':
-                    flattened.append(r['activity'])
-                elif r['type'] == 'perform_search':
-                    flattened.append(r['object'])
-                elif r['type'] == 'task_end':
-                    flattened.append(r['message'])
-                elif r['type'] == 'action_end':
-                    flattened.append(r['result'])
-                elif r['type'] == 'task':
-                    flattened.append(r['instruction'])
-                elif r['type'] == 'query_to_human':
-                    flattened.append(r['query'])
-                else:
-                    raise NotImplementedError(r)
+                flattened.append(self._query_text(r))
         return self.sim_model.encode(flattened, convert_to_tensor=True), idx_map
 
-    @cached_property
-    def _prompt_embeddings_cache(self):
-        return self._calc_prompt_embeddings_and_idx_map([q for p, q in self.prompt_db])
+    @staticmethod
+    def _query_text(r: dict) -> str:
+        if r['type'] == 'dialog':
+            return r['text']
+        elif r['type'] == 'action_recognition':
+            return r['activity']
+        elif r['type'] == 'perform_search':
+            return r['object']
+        elif r['type'] == 'task_end':
+            return r['message']
+        elif r['type'] == 'action_end':
+            return r['result']
+        elif r['type'] == 'task':
+            return r['instruction']
+        elif r['type'] == 'query_to_human':
+            return r['query']
+        else:
+            raise NotImplementedError(r)
+
+    def _index_keys(self, responses: List[dict]):
+        return [(self._query_text(r), r['type']) for r in responses]
+
+    def _prompt_index_keys(self, p: str):
+        return self._index_keys(self._extract_responses_from_prompt(p))
 
-    def __call__(self, exec_history: str, loop_detected=False):
+    def __call__(self, exec_history: str = None, loop_detected=False, user_responses: Sequence[UserResponse] = None,
+                 reserved_tokens=0, record_hits=True):
         """
         :param exec_history: the full exec history. user queries are extracted from that
+        :param user_responses: the user responses tracked by ExecutionHistory. If given, exec_history is not needed
+        :param reserved_tokens: tokens of the prompt that are added by the caller (imports, history), which the
+            examples must leave room for if there is a token_budget
+        :param record_hits: whether to count the retrieved examples as used (for eviction), False e.g. for prompts that
+            might not be used
         :return:
         """
+        with self._lock:
+            return self._build(exec_history, loop_detected, user_responses, reserved_tokens, record_hits)
+
+    def _build(self, exec_history: str, loop_detected: bool, user_responses: Optional[Sequence[UserResponse]],
+               reserved_tokens: int, record_hits: bool):
         suffix = self.prompt_separator + self.prompt_suffix if self.prompt_suffix else ''
+        # Static parts first, so that they are a common prefix of all prompts
+        head = self.base_prompt + ''.join(self.prompt_separator + p for p in self.pinned_prompt_db)
 
         if loop_detected:
-            return self.base_prompt + self.prompt_separator + self.loop_prevention_prompt + suffix
+            return head + self.prompt_separator + self.loop_prevention_prompt + suffix
+
+        self._learned_prompts.fetch_changes()
+        if len(self._learned_prompts) == 0:
+            return head + suffix
+
+        if user_responses is None:
+            query_types, combined_query_feats = self.query_from_exec_history(exec_history)
+        else:
+            query_types, combined_query_feats = self._combine_user_responses(user_responses)
+
+        index = self._learned_prompts.index
+        num_candidates = self.top_k if self.token_budget is None else 2 * self.top_k
+        # Look beyond top_k, to fill the budget when some of the most similar examples are too long
+        candidates = index.search(combined_query_feats, num_candidates + len(self.pinned_prompt_db), query_types)
+        if self.pinned_prompt_db:
+            pinned = set(self.pinned_prompt_db)
+            candidates = [i for i in candidates if index.prompts[i] not in pinned][:num_candidates]
+        if self.token_budget is None:
+            top_indices = candidates
+        else:
+            top_indices = self._select_within_budget(candidates, self.count_tokens(head + suffix), reserved_tokens)
+        if record_hits:
+            self._learned_prompts.record_hits(top_indices)
+        if self.layout == 'stable':
+            top_prompts = [index.prompts[i] for i in sorted(top_indices)]
+        else:
+            top_prompts = [index.prompts[i] for i in reversed(top_indices)]
 
-        if len(self.prompt_db) == 0:
-            return self.base_prompt + suffix
+        final_prompt = (
+                head + self.prompt_separator +
+                self.prompt_separator.join(top_prompts) +
+                suffix
+        )
+        return final_prompt
 
+    def _select_within_budget(self, candidates: List[int], fixed_tokens: int, reserved_tokens: int) -> List[int]:
+        """Greedily take the most similar candidates that fit into the remaining token budget"""
+        remaining = self.token_budget - fixed_tokens - reserved_tokens
+        separator_tokens = self.count_tokens(self.prompt_separator)
+        selected = []
+        example_tokens = 0
+        for i in candidates:
+            tokens = self.count_tokens(self._learned_prompts.index.prompts[i]) + separator_tokens
+            if tokens <= remaining:
+                selected.append(i)
+                remaining -= tokens
+                example_tokens += tokens
+                if len(selected) == self.top_k:
+                    break
+        self.last_token_counts = dict(base=fixed_tokens, examples=example_tokens, num_examples=len(selected),
+                                      num_candidates=len(candidates))
+        return selected
+
+    def query_from_exec_history(self, exec_history: str):
+        """:return: the types and combined embedding of the last user responses in the given history"""
         query_history = self._extract_responses_from_prompt(exec_history)
         query_history = list(reversed(query_history))[:self.query_keep_last_n]
-        # now, query history is from most recent (index 0) to oldest (index query_keep_last_n - 1)
-        query_types = {q['type'] for q in query_history}
         query_hist_feats, _ = self._calc_prompt_embeddings_and_idx_map([query_history])
+        return self._combine_query_history(query_history, query_hist_feats)
+
+    def _combine_query_history(self, query_history: List[dict], query_hist_feats: torch.Tensor):
+        # query history is from most recent (index 0) to oldest (index query_keep_last_n - 1)
+        query_types = {q['type'] for q in query_history}
         decay = self.query_history_importance_decay * torch.ones(len(query_history), device=self.sim_model.device)
         decay **= torch.arange(len(query_history), device=decay.device)
         combined_query_feats = (query_hist_feats * decay[:, None]).sum(dim=0)
+        return query_types, combined_query_feats
 
-        prompt_embeddings, idx_map = self._prompt_embeddings_cache
-        filter_by_type_indices = [i for i, d in enumerate(d for p, ds in self.prompt_db for d in ds)
-                                  if d['type'] in query_types]
-        prompt_embeddings = prompt_embeddings[filter_by_type_indices]
-        idx_map = [idx for i, idx in enumerate(idx_map) if i in filter_by_type_indices]
-
-        similarities = util.cos_sim(combined_query_feats, prompt_embeddings).squeeze()
-        top_indices = similarities.argsort(descending=True)
-        top_prompts = []  # To avoid duplicates
-        for i in top_indices:
-            if len(top_prompts) == self.top_k:
-                break
-            p = self.prompt_db[idx_map[i]][0]
-            if p not in top_prompts:
-                top_prompts.append(p)
+    def _combine_user_responses(self, user_responses: Sequence[UserResponse]):
+        """Like _combine_query_history, but parses and encodes each user response only once"""
+        window = tuple(reversed(user_responses[max(len(user_responses) - self.query_keep_last_n, 0):]))
+        if not window:
+            return set(), torch.zeros(self.sim_model.get_sentence_embedding_dimension(), device=self.sim_model.device)
+        if window == self._last_query_window:
+            return self._last_combined_query
 
-        final_prompt = (
-                self.base_prompt + self.prompt_separator +
-                self.prompt_separator.join(reversed(top_prompts)) +
-                suffix
-        )
-        return final_prompt
+        new_responses = [r for r in window if r not in self._query_cache]
+        if new_responses:
+            parsed = [self._parse_response(r.text, r.text) for r in new_responses]
+            encoded = self.sim_model.encode([self._query_text(q) for q in parsed], convert_to_tensor=True)
+            self._query_cache.update(zip(new_responses, zip(parsed, encoded)))
+        self._query_cache = {r: self._query_cache[r] for r in window}  # Only keep what is still needed
+
+        query_history = [self._query_cache[r][0] for r in window]
+        query_hist_feats = torch.stack([self._query_cache[r][1] for r in window])
+        self._last_query_window = window
+        self._last_combined_query = self._combine_query_history(query_history, query_hist_feats)
+        return self._last_combined_query
 
     def remember_interaction(self, interaction: str, **kwargs):
+        with self._lock:
+            self._remember_interaction(interaction)
+
+    def _remember_interaction(self, interaction: str):
         try:
             self._extract_responses_from_prompt(interaction)
         except SyntaxError:
@@ -171,13 +299,17 @@ class DynamicPromptBuilder:
             print(interaction)
             return
 
-        self.custom_prompt_db.append(interaction)
-        if self.custom_prompt_db_file:
-            print('Writing custom_prompt_db_file', self.custom_prompt_db_file)
-            self.custom_prompt_db_file.write_text(json.dumps(self.custom_prompt_db))
+        duplicate_of = self._learned_prompts.learn(interaction)
+        if duplicate_of is not None:
+            print('Will not save interaction, it is a near-duplicate of a learned one:')
+            print(duplicate_of)
+
+    @staticmethod
+    def duplicate_signature(prompt: str) -> str:
+        """The text that near-duplicate prompts have in common, i.e. the user responses they are retrieved by"""
+        return '\n'.join(DynamicPromptBuilder._query_text(r)
+                          for r in DynamicPromptBuilder._extract_responses_from_prompt(prompt))
 
-        # invalidate caches
-        # noinspection PyPropertyAccess
-        del self.prompt_db
-        # noinspection PyPropertyAccess
-        del self._prompt_embeddings_cache
+    def flush_hits(self):
+        """Persist the usage statistics that are still pending, which otherwise happens when learning and at exit"""
+        self._learned_prompts.flush_hits()
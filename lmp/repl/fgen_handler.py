@@ -1,3 +1,6 @@
+from concurrent.futures import Executor
+from typing import Optional
+
 from .util import ExecutionHistory
 from ..function_gen_lmp import FunctionGenerationLMP
 
@@ -13,7 +16,17 @@ class ReplFunctionGenerationHandler:
         assert isinstance(last_command, ExecutionHistory.Command)
 
         definitions = self._fgen_lmp.create_new_fs_from_code(last_command.code)
+        self._insert_definitions(execution_history, definitions, last_command)
+
+    async def acall(self, execution_history: ExecutionHistory, executor: Optional[Executor] = None):
+        last_command = execution_history.items.pop()
+        assert isinstance(last_command, ExecutionHistory.Command)
+
+        definitions = await self._fgen_lmp.acreate_new_fs_from_code(last_command.code, executor)
+        self._insert_definitions(execution_history, definitions, last_command)
 
+    @staticmethod
+    def _insert_definitions(execution_history: ExecutionHistory, definitions, last_command):
         # Define the functions (this is not actually executed, but functions are already
         #  defined by fgen_lmp which shares the code execution environment)
         for f_def in definitions.values():
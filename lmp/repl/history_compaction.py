@@ -0,0 +1,122 @@
+from typing import List, Tuple, Dict, Optional
+
+from .util import END_OF_TASK, ExecutionHistory
+from ..token_count import TokenCounter
+
+
+class HistoryCompactor:
+    """
+    Renders an ExecutionHistory for the prompt within a token budget. The history is split into tasks, each ending with
+    wait_for_trigger(). If the full history exceeds the budget, completed tasks are collapsed into one-line summaries
+    (oldest first) until it fits, except for the last keep_last_n. If that is not enough, the oldest summaries are
+    omitted. The current task is always kept verbatim.
+
+    Summaries are built without an LLM, by folding the commands of a task with their results, e.g.
+        {'type': 'dialog', 'text': 'put the red block in the bowl'}
+        >>> # Done: put_first_on_second('red block', 'bowl') -> 'success'; say('Done.')
+        >>> wait_for_trigger()
+    Token counts and summaries are cached per item / task, so that only new items are processed in each round.
+    """
+
+    def __init__(self, count_tokens: TokenCounter, token_budget: int, keep_last_n=2, max_step_length=60,
+                 cache_size=1000) -> None:
+        """
+        :param token_budget: (approximate) maximum number of tokens of the rendered history
+        :param keep_last_n: number of most recent completed tasks which are never summarized
+        :param max_step_length: commands and results are shortened to this many characters in summaries
+        """
+        super().__init__()
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.keep_last_n = keep_last_n
+        self.max_step_length = max_step_length
+        self.cache_size = cache_size
+        self._summaries: Dict[Tuple[str, ...], str] = {}
+        # Statistics of the last call, for reporting. Empty if the history was not compacted.
+        self.last_stats: Dict[str, int] = {}
+
+    def __call__(self, exec_hist: ExecutionHistory) -> str:
+        rendered = exec_hist.rendered_items
+        # One token for each newline joining the items
+        item_tokens = [self.count_tokens(r) + 1 for r in rendered]
+        total = sum(item_tokens)
+        self.last_stats = {}
+        if total <= self.token_budget:
+            return str(exec_hist)
+
+        tasks = self._split_tasks(exec_hist.items)
+        completed = tasks[:-1]  # The last is the current task (possibly empty)
+        parts: List[Optional[str]] = [None] * len(completed)  # Summary, or None for verbatim
+        tokens = total
+        num_summarized = num_omitted = 0
+        for i, (start, end) in enumerate(completed[:max(len(completed) - self.keep_last_n, 0)]):
+            if tokens <= self.token_budget:
+                break
+            parts[i] = self._summary(tuple(rendered[start:end]), exec_hist.items[start:end])
+            tokens += self.count_tokens(parts[i]) + 1 - sum(item_tokens[start:end])
+            num_summarized += 1
+        for i, (start, end) in enumerate(completed):
+            if tokens <= self.token_budget or parts[i] is None:
+                break
+            tokens -= self.count_tokens(parts[i]) + 1
+            parts[i] = ''
+            num_omitted += 1
+
+        texts = []
+        for (start, end), part in zip(completed, parts):
+            if part is None:
+                texts.extend(rendered[start:end])
+            elif part:
+                texts.append(part)
+        current_start = tasks[-1][0]
+        texts.extend(rendered[current_start:])
+        self.last_stats = dict(full_tokens=total, tokens=tokens, summarized=num_summarized - num_omitted,
+                               omitted=num_omitted)
+        return '\n'.join(texts)
+
+    @staticmethod
+    def _split_tasks(items: List) -> List[Tuple[int, int]]:
+        """:return: (start, end) item indices of each task, the last one being the current (not completed) task"""
+        tasks = []
+        start = 0
+        for i, item in enumerate(items):
+            if isinstance(item, ExecutionHistory.Command) and item.code == END_OF_TASK:
+                tasks.append((start, i + 1))
+                start = i + 1
+        tasks.append((start, len(items)))
+        return tasks
+
+    def _summary(self, key: Tuple[str, ...], items: List) -> str:
+        summary = self._summaries.get(key)
+        if summary is None:
+            summary = self._fold(items)
+            if len(self._summaries) >= self.cache_size:
+                self._summaries.clear()
+            self._summaries[key] = summary
+        return summary
+
+    def _fold(self, items: List) -> str:
+        lines = []
+        if items and isinstance(items[0], ExecutionHistory.ExecutionResult):
+            lines.append(items[0].content)  # The user request, which the preceding wait_for_trigger() waits for
+            items = items[1:]
+        steps = []
+        for i, item in enumerate(items):
+            if not isinstance(item, ExecutionHistory.Command) or item.code == END_OF_TASK:
+                continue
+            code = item.code.strip()
+            if code.startswith('#'):
+                continue
+            step = self._shorten(code.splitlines()[0] + (' ...' if '\n' in code else ''))
+            following = items[i + 1] if i + 1 < len(items) else None
+            if isinstance(following, ExecutionHistory.ExecutionResult):
+                result = following.content.strip().splitlines()
+                # The last line of a result is the most informative, e.g. the message of an error
+                step += ' -> ' + self._shorten(result[-1] if result else '')
+            steps.append(step)
+        lines.append('>>> # Done: ' + ('; '.join(steps) if steps else 'nothing'))
+        lines.append(str(ExecutionHistory.Command(END_OF_TASK)))
+        return '\n'.join(lines)
+
+    def _shorten(self, text: str) -> str:
+        return text if len(text) <= self.max_step_length else text[:self.max_step_length - 3] + '...'
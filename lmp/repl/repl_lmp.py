@@ -1,6 +1,12 @@
 import ast
+import asyncio
+import re
+import threading
+import time
 import traceback
-from typing import Union, List, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, Executor
+from typing import Union, List, Optional, Sequence, Tuple, Deque, Dict, Generator
 
 from langchain.schema.language_model import BaseLanguageModel
 
@@ -8,11 +14,12 @@ from .code_execution import ReplExecutionEnvironment
 from .dynamic_prompt import DynamicPromptBuilder, END_OF_TASK
 from .error_handlers import ErrorHandler
 from .fgen_handler import ReplFunctionGenerationHandler
+from .history_compaction import HistoryCompactor
 from .learn_from_interaction import LearnFromInteractionModule
 from .semantic_hint_errror import SemanticHintError
-from .util import ExecutionHistory
+from .util import ExecutionHistory, WAIT_FOR_USER_INPUT
 from ..lmp import LMPBase
-from ..util import print_code
+from ..util import print_code, common_prefix_length
 
 
 class ReplLMP(LMPBase):
@@ -30,6 +37,18 @@ class ReplLMP(LMPBase):
                  max_rounds=100,
                  reset_state_on_result_fn=True,
                  allow_learn_from_interaction_without_user_request=False,
+                 # Summarize older tasks of the execution history in the prompt, to stay within this many tokens
+                 history_token_budget: int = None,
+                 history_keep_last_n=2,  # Most recent completed tasks that are never summarized
+                 report_prefix_reuse=False,  # Print how many tokens each prompt shares with the previous one
+                 # Stream the LLM output, and cancel the request as soon as the first statement is complete
+                 stream=False,
+                 # Let the LLM continue after the first statement, and execute the following statements without
+                 # querying it again as long as the actual results match the ones it predicted
+                 optimistic_execution=False,
+                 # Long-running API functions, with the result to assume if the LLM did not predict one. While they
+                 # run, the next statement is generated in the background, and used if the actual result matches.
+                 speculative_calls: Dict[str, str] = None,
                  verbose=True) -> None:
         super().__init__(llm, code_execution_env)
         self._fgen_handler = (lambda x: None) if fgen_lmp is None else ReplFunctionGenerationHandler(fgen_lmp)
@@ -48,32 +67,108 @@ class ReplLMP(LMPBase):
         self._verbose = verbose
         self._reset_state_on_result_fn = reset_state_on_result_fn
         self._allow_learn_from_interaction_without_user_request = allow_learn_from_interaction_without_user_request
+        self._history_compactor = None if history_token_budget is None else HistoryCompactor(
+            prompt_builder.count_tokens, history_token_budget, history_keep_last_n)
+
+        self._report_prefix_reuse = report_prefix_reuse
+        if stream and optimistic_execution:
+            raise ValueError('stream and optimistic_execution cannot be combined, streaming stops after one statement')
+        self._stream = stream
+        self._optimistic_execution = optimistic_execution
+        # Statements (with their expected output) predicted by the last generation, to be executed next
+        self._plan: Deque[Tuple[str, str]] = deque()
+        self.optimistic_stats = dict(generated=0, planned=0, discarded=0)
+        self._speculative_calls = speculative_calls or {}
+        self._speculative_call_pattern = re.compile(
+            r'\b(' + '|'.join(map(re.escape, self._speculative_calls)) + r')\(') if speculative_calls else None
+        self._speculation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='speculation')
+        self._speculation: Optional[_Speculation] = None
+        # Speculative prompts are built in the background, while the next prompt might already be built
+        self._build_prompt_lock = threading.Lock()
+        self.speculation_stats = dict(started=0, hits=0, time_saved=0.0)
+        self._previous_prompt = None
+        # Prefix tokens shared with the previous prompt, and prompt tokens, summed over all prompts
+        self.prefix_reuse_totals = [0, 0]
 
         self._learn_from_interaction_handler = learn_from_interaction_module
         if learn_from_interaction_module:
             self.code_execution_env.namespace.predefined_globals[
                 'learn_from_interaction'] = self._learn_from_interaction
-        self.exec_hist = ExecutionHistory()
+        self.exec_hist = ExecutionHistory(preceding_text=END_OF_TASK)
         self._interrupted = False
         self._currently_executed_statement = None
 
-    def _build_prompt(self, loop_detected=False):
-        variable_vars_imports_str = self._create_import_statements()
-        base = self._prompt_builder(f'{END_OF_TASK}\n{self.exec_hist}\n', loop_detected)
+    def _build_prompt(self, loop_detected=False, speculative=False, exec_hist: ExecutionHistory = None,
+                      variable_vars_imports_str: str = None):
+        """
+        :param speculative: for a speculative generation (see _speculate), which must neither count as a retrieval of
+            the examples, nor be reported or compared for prefix reuse, since the prompt is built again when it is used
+        :param exec_hist: the history to build the prompt for, self.exec_hist if None
+        :param variable_vars_imports_str: the imports, of the current namespace if None
+        """
+        if exec_hist is None:
+            exec_hist = self.exec_hist
+        if variable_vars_imports_str is None:
+            variable_vars_imports_str = self._create_import_statements()
+        with self._build_prompt_lock:
+            return self._build_prompt_locked(loop_detected, speculative, exec_hist, variable_vars_imports_str)
+
+    def _build_prompt_locked(self, loop_detected: bool, speculative: bool, exec_hist: ExecutionHistory,
+                             variable_vars_imports_str: str):
+        if self._history_compactor is None:
+            exec_hist_str = str(exec_hist)
+        else:
+            exec_hist_str = self._history_compactor(exec_hist)
+            stats = self._history_compactor.last_stats
+            if stats and not speculative:
+                print(f'History compacted from {stats["full_tokens"]} to {stats["tokens"]} tokens '
+                      f'({stats["summarized"]} tasks summarized, {stats["omitted"]} omitted)')
+        reserved_tokens = 0
+        if self._prompt_builder.token_budget is not None:
+            count_tokens = self._prompt_builder.count_tokens
+            import_tokens = count_tokens(variable_vars_imports_str)
+            history_tokens = count_tokens.count_uncached(exec_hist_str)  # Different in every round
+            reserved_tokens = import_tokens + history_tokens
+        base = self._prompt_builder(loop_detected=loop_detected, user_responses=exec_hist.user_responses,
+                                    reserved_tokens=reserved_tokens, record_hits=not speculative)
         base = base.replace('{variable_vars_imports}', variable_vars_imports_str)
         assert base.endswith(END_OF_TASK)
         prompt = (f'{base}\n'
-                  f'{self.exec_hist}')
+                  f'{exec_hist_str}')
+        if speculative:
+            return prompt
+        if reserved_tokens and self._prompt_builder.last_token_counts and not loop_detected:
+            counts = self._prompt_builder.last_token_counts
+            print(f'Prompt tokens: {counts["base"] + counts["examples"] + reserved_tokens} of '
+                  f'{self._prompt_builder.token_budget} (base {counts["base"]}, imports {import_tokens}, '
+                  f'examples {counts["examples"]} [{counts["num_examples"]} of {counts["num_candidates"]} candidates], '
+                  f'history {history_tokens})')
+        if self._report_prefix_reuse:
+            self._measure_prefix_reuse(prompt)
         return prompt
 
+    def _measure_prefix_reuse(self, prompt: str):
+        """Estimate the benefit of prompt (prefix) caching by the LLM provider"""
+        previous, self._previous_prompt = self._previous_prompt, prompt
+        if previous is None:
+            return
+        count_tokens = self._prompt_builder.count_tokens.count_uncached
+        shared_tokens = count_tokens(prompt[:common_prefix_length(previous, prompt)])
+        tokens = count_tokens(prompt)
+        self.prefix_reuse_totals[0] += shared_tokens
+        self.prefix_reuse_totals[1] += tokens
+        print(f'Prefix reuse: {shared_tokens} of {tokens} tokens ({shared_tokens / tokens:.0%}) shared with the '
+              f'previous prompt, {self.prefix_reuse_totals[0] / self.prefix_reuse_totals[1]:.0%} overall')
+
     def _create_import_statements(self):
         variable_vars_imports_str = self.code_execution_env.namespace.build_import_statement(
             use_defs=True, line_separator='\ndef ', exclude=self._exclude_imports)
         return variable_vars_imports_str
 
     def reset(self):
-        self.exec_hist = ExecutionHistory()
+        self.exec_hist = ExecutionHistory(preceding_text=END_OF_TASK)
         self._interrupted = False
+        self._plan.clear()
         self.code_execution_env.namespace.clear()  # This only deletes the locals.
         for handler in self._error_handlers:
             handler.reset()
@@ -87,7 +182,105 @@ class ReplLMP(LMPBase):
     def currently_executed_statement(self) -> Optional[str]:
         return self._currently_executed_statement
 
+    @property
+    def prompt_builder(self) -> DynamicPromptBuilder:
+        return self._prompt_builder
+
+    def close(self):
+        """Stops the background thread used for speculative generation and persists pending prompt usage statistics"""
+        self._discard_speculation()
+        self._speculation_executor.shutdown(wait=False, cancel_futures=True)
+        self._prompt_builder.flush_hits()
+
     def __call__(self, query: Union[str, dict]):
+        steps = self._steps(query)
+        step = self._advance(steps)
+        while step[0] != 'return':
+            try:
+                if step[0] == 'build_prompt':
+                    outcome = self._build_prompt(*step[1:])
+                elif step[0] == 'generate':
+                    outcome = self._take_speculation(step[1])
+                    if outcome is None:
+                        outcome = self._generate(step[1])
+                elif step[0] == 'execute':
+                    outcome = self._execute(*step[1:])
+                else:
+                    raise ValueError(step[0])
+            except BaseException as e:
+                step = self._advance(steps, error=e)
+            else:
+                step = self._advance(steps, outcome)
+        return step[1]
+
+    async def acall(self, query: Union[str, dict], executor: Optional[Executor] = None):
+        """
+        Like __call__, but awaits the LLM calls, so that a single event loop can drive many sessions at once.
+        Building prompts (which includes embedding lookups) and executing statements (i.e. API calls, which might
+        block for a long time, e.g. while the robot moves) run in the executor (the event loop's default if None).
+        Note that nested LMPs called by the executed code run synchronously there as well. StopIteration (i.e. max
+        rounds reached) cannot propagate out of a coroutine, and is raised as RuntimeError instead.
+        """
+        loop = asyncio.get_running_loop()
+        steps = self._steps(query)
+        step = self._advance(steps)
+        while step[0] != 'return':
+            try:
+                if step[0] == 'build_prompt':
+                    outcome = await loop.run_in_executor(executor, self._build_prompt, *step[1:])
+                elif step[0] == 'generate':
+                    outcome = await self._atake_speculation(step[1])
+                    if outcome is None:
+                        outcome = await self._agenerate(step[1])
+                elif step[0] == 'execute':
+                    if isinstance(self._fgen_handler, ReplFunctionGenerationHandler):
+                        await self._fgen_handler.acall(self.exec_hist, executor)
+                    outcome, stop = await loop.run_in_executor(executor, self._execute_returning_stop, *step[1:])
+                    if stop is not None:
+                        raise stop
+                else:
+                    raise ValueError(step[0])
+            except BaseException as e:
+                step = self._advance(steps, error=e)
+            else:
+                step = self._advance(steps, outcome)
+        return step[1]
+
+    @staticmethod
+    def _advance(steps: Generator, outcome=None, error: BaseException = None) -> tuple:
+        """Pass the outcome (or error) of a step to the REPL loop and get the next step, ('return', value) at the end"""
+        try:
+            step = steps.send(outcome) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return 'return', e.value
+        if step[0] == 'raise':
+            steps.close()
+            raise step[1]
+        return step
+
+    def _execute(self, code_str: str, expected_output_str: Optional[str], generate_functions=True):
+        if generate_functions and self._fgen_handler:
+            self._fgen_handler(self.exec_hist)
+        self._currently_executed_statement = code_str
+        self._speculate(code_str, expected_output_str)
+        return self.code_execution_env(code_str)
+
+    def _execute_returning_stop(self, code_str: str, expected_output_str: Optional[str]):
+        """StopIteration (as raised by return functions) cannot be set as the exception of an asyncio future"""
+        try:
+            return self._execute(code_str, expected_output_str, generate_functions=False), None
+        except StopIteration as e:
+            return None, e
+
+    def _steps(self, query: Union[str, dict]) -> Generator[tuple, object, object]:
+        """
+        The REPL loop, independent of how its steps are carried out. It yields the steps to carry out:
+            ('build_prompt', loop_detected) -> the prompt
+            ('generate', prompt) -> the LLM output
+            ('execute', code_str, expected_output_str) -> the results of the statement
+            ('raise', exception), since a generator cannot raise StopIteration itself
+        The outcome of each step is sent back, or its exception is thrown into the generator.
+        """
         # query str may also be repr of a dict. code below handles this.
         if isinstance(query, str):
             if not query.startswith('{'):
@@ -100,33 +293,49 @@ class ReplLMP(LMPBase):
         self.exec_hist.items.append(ExecutionHistory.InputPrompt())
         loop_detected = False
         generation_history = []
+        self._plan.clear()
+        self._discard_speculation()
 
         while True:
             if len(generation_history) >= self._max_rounds:
-                raise StopIteration('Max rounds reached.')
+                yield 'raise', StopIteration('Max rounds reached.')
             if self._interrupted:
                 self._interrupted = False
+                self._plan.clear()
                 self.exec_hist.items.append(ExecutionHistory.Command(END_OF_TASK))
                 return  # Interrupt does not clear the exec hist. It just causes top-level wait_for_trigger again.
 
-            if isinstance(self.exec_hist.items[-1], ExecutionHistory.InputPrompt):
-                prompt = self._build_prompt(loop_detected)
+            if isinstance(self.exec_hist.items[-1], ExecutionHistory.InputPrompt) and self._plan:
+                self.exec_hist.items.pop()
+                code_str, expected_output_str = self._plan.popleft()
+                self.optimistic_stats['planned'] += 1
+                if self._verbose:
+                    print('Executing planned statement without querying LLM:', code_str)
+                generation_history.append(code_str)
+                should_insert_cmd_into_history = True
+            elif isinstance(self.exec_hist.items[-1], ExecutionHistory.InputPrompt):
+                prompt = yield 'build_prompt', loop_detected
                 self.exec_hist.items.pop()
                 if self._verbose:
                     print_code(prompt)
-                code_str_with_expected_reply = self._generate(prompt)
+                code_str_with_expected_reply = yield 'generate', prompt
                 code_str, expected_output_str = self._split_llm_output(code_str_with_expected_reply)
+                if self._optimistic_execution:
+                    self._plan.extend(self._parse_plan(code_str_with_expected_reply))
+                    self.optimistic_stats['generated'] += 1
                 generation_history.append(code_str)
                 should_insert_cmd_into_history = True
             elif isinstance(self.exec_hist.items[-1], ExecutionHistory.Command):
                 if self._verbose:
                     print('Executing already scheduled code without querying LLM')
                 code_str = self.exec_hist.items[-1].code
+                expected_output_str = None
                 should_insert_cmd_into_history = False
             else:
                 raise TypeError(type(self.exec_hist.items[-1]))
 
             if self._detect_generation_loop(generation_history):
+                self._discard_plan('loop detected')
                 if loop_detected:  # Second time loop => reset and cancel
                     self.reset()
                     self._say('Sorry, I do not know how to proceed.')
@@ -148,10 +357,7 @@ class ReplLMP(LMPBase):
                 continue
 
             try:
-                if self._fgen_handler:
-                    self._fgen_handler(self.exec_hist)
-                self._currently_executed_statement = code_str
-                results = self.code_execution_env(code_str)
+                results = yield 'execute', code_str, expected_output_str
                 if self._verbose:
                     print('Results:', results)
                 for handler in self._error_handlers:
@@ -162,9 +368,10 @@ class ReplLMP(LMPBase):
                         self.reset()  # Nested REPL shell should not keep state over different invocations
                     return e.value[1]
                 else:
-                    raise
+                    yield 'raise', e
             except BaseException as e:
                 traceback.print_exc()
+                self._discard_plan('error')
                 handled = False
                 for handler in self._error_handlers:
                     if handler.can_handle(e):
@@ -181,52 +388,263 @@ class ReplLMP(LMPBase):
                 if r is None:
                     continue
                 self.exec_hist.items.append(ExecutionHistory.ExecutionResult(repr(r)))
+            if self._plan:
+                actual_output = '\n'.join(repr(r) for r in results if r is not None)
+                if expected_output_str is None or actual_output.strip() != expected_output_str.strip():
+                    self._discard_plan(f'result {actual_output!r} differs from the predicted {expected_output_str!r}')
             self.exec_hist.items.append(ExecutionHistory.InputPrompt())
 
+    def _speculate(self, code_str: str, expected_output_str: Optional[str]):
+        """
+        If the statement calls a long-running API function, start generating the statement following it in the
+        background, assuming that it results in the predicted output
+        """
+        self._discard_speculation()
+        if self._speculative_call_pattern is None or self._plan:
+            return
+        match = self._speculative_call_pattern.search(code_str)
+        if match is None:
+            return
+        assumed_output = expected_output_str.strip() if expected_output_str else self._speculative_calls[match[1]]
+        if self._verbose:
+            print(f'Generating the next statement in the background, assuming {code_str} results in {assumed_output}')
+        # Only the snapshots are taken here, the prompt is built in the background as well
+        prompt = Future()
+        future = self._speculation_executor.submit(self._speculative_generate, self.exec_hist.copy(),
+                                                   self._create_import_statements(), assumed_output, prompt)
+        self._speculation = _Speculation(prompt, future)
+        self.speculation_stats['started'] += 1
+
+    def _speculative_generate(self, exec_hist: ExecutionHistory, variable_vars_imports_str: str, assumed_output: str,
+                              prompt_future: Future) -> Optional[Tuple[str, float]]:
+        """:param prompt_future: set to the speculative prompt as soon as it is built, so that it can be compared"""
+        if not prompt_future.set_running_or_notify_cancel():
+            return None  # Discarded meanwhile
+        try:
+            # The prompt is built as it will be after the statement, so that it can be compared then
+            if assumed_output:
+                exec_hist.items.append(ExecutionHistory.ExecutionResult(assumed_output))
+            exec_hist.items.append(ExecutionHistory.InputPrompt())
+            prompt = self._build_prompt(speculative=True, exec_hist=exec_hist,
+                                        variable_vars_imports_str=variable_vars_imports_str)
+        except BaseException as e:
+            prompt_future.set_exception(e)
+            raise
+        prompt_future.set_result(prompt)
+        return self._timed_generate(prompt)
+
+    def _timed_generate(self, prompt: str) -> Tuple[str, float]:
+        start = time.perf_counter()
+        result = self._generate(prompt)
+        return result, time.perf_counter() - start
+
+    def _take_speculation(self, prompt: str) -> Optional[str]:
+        """:return: the speculatively generated output, if it was generated for this prompt"""
+        speculation, self._speculation = self._speculation, None
+        if speculation is None:
+            return None
+        waited_since = time.perf_counter()
+        try:
+            if not self._speculation_matches(speculation, speculation.prompt.result(), prompt):
+                return None
+            result, duration = speculation.future.result()
+        except Exception:
+            traceback.print_exc()
+            return None
+        return self._use_speculation(result, duration, waited_since)
+
+    async def _atake_speculation(self, prompt: str) -> Optional[str]:
+        speculation, self._speculation = self._speculation, None
+        if speculation is None:
+            return None
+        waited_since = time.perf_counter()
+        try:
+            if not self._speculation_matches(speculation, await asyncio.wrap_future(speculation.prompt), prompt):
+                return None
+            result, duration = await asyncio.wrap_future(speculation.future)
+        except Exception:
+            traceback.print_exc()
+            return None
+        return self._use_speculation(result, duration, waited_since)
+
+    def _speculation_matches(self, speculation: '_Speculation', speculative_prompt: str, prompt: str) -> bool:
+        if speculative_prompt != prompt:
+            if self._verbose:
+                print('Discarding speculatively generated statement, the actual result differs')
+            speculation.cancel()
+            return False
+        return True
+
+    def _discard_speculation(self):
+        """Cancels the speculative generation, unless it is already running (then its result is just not used)"""
+        speculation, self._speculation = self._speculation, None
+        if speculation is not None:
+            speculation.cancel()
+
+    def _use_speculation(self, result: str, duration: float, waited_since: float) -> str:
+        # The generation ran in parallel to the execution, except for the time waited for it to finish
+        time_saved = max(duration - (time.perf_counter() - waited_since), 0)
+        self.speculation_stats['hits'] += 1
+        self.speculation_stats['time_saved'] += time_saved
+        stats = self.speculation_stats
+        print(f'Using speculatively generated statement, saved {time_saved:.2f}s '
+              f'(hit rate {stats["hits"]}/{stats["started"]}, {stats["time_saved"]:.2f}s saved in total)')
+        return result
+
     def _generate(self, prompt: str):
-        kwargs = dict(text=prompt, **self._llm_kwargs)
+        kwargs = self._generation_kwargs(prompt)
         result = ''
 
         while result == '':
             print({k: v for k, v in kwargs.items() if k != 'text'})
-            result = self.llm.predict(**kwargs).strip()
-            if result == '':
-                if 'temperature' in kwargs:
-                    kwargs['temperature'] += 0.1
-                    if kwargs['temperature'] > 1:
-                        break
-                else:
-                    kwargs['temperature'] = 0.1
-                print(f'LLM generated empty reply, increasing temperature to {kwargs["temperature"]}')
+            result = (self._predict_first_statement(**kwargs) if self._stream else self.llm.predict(**kwargs)).strip()
+            if result == '' and not self._increase_temperature(kwargs):
+                break
+
+        return self._substitute_empty_reply(result)
+
+    async def _agenerate(self, prompt: str):
+        kwargs = self._generation_kwargs(prompt)
+        result = ''
+
+        while result == '':
+            print({k: v for k, v in kwargs.items() if k != 'text'})
+            result = (await self._apredict_first_statement(**kwargs) if self._stream
+                      else await self.llm.apredict(**kwargs)).strip()
+            if result == '' and not self._increase_temperature(kwargs):
+                break
+
+        return self._substitute_empty_reply(result)
+
+    def _generation_kwargs(self, prompt: str) -> dict:
+        kwargs = dict(text=prompt, **self._llm_kwargs)
+        if self._optimistic_execution:
+            kwargs['stop'] = [s for s in kwargs['stop'] if s != '>>>']  # Generate a plan of several statements
+        return kwargs
+
+    @staticmethod
+    def _increase_temperature(kwargs: dict) -> bool:
+        """After an empty reply. :return: False if the temperature cannot be increased any further"""
+        if 'temperature' in kwargs:
+            kwargs['temperature'] += 0.1
+            if kwargs['temperature'] > 1:
+                return False
+        else:
+            kwargs['temperature'] = 0.1
+        print(f'LLM generated empty reply, increasing temperature to {kwargs["temperature"]}')
+        return True
 
+    @staticmethod
+    def _substitute_empty_reply(result: str) -> str:
         if result == '':
             print(f'LLM generated empty reply, substituting this with {END_OF_TASK}')
             return END_OF_TASK
         return result
 
+    def _predict_first_statement(self, text: str, stop: Sequence[str] = None, **kwargs) -> str:
+        """
+        Like self.llm.predict, but streams the output and stops generating once the first statement (with its
+        continuation lines) is complete, since _split_llm_output discards everything after it anyway
+        """
+        start = time.perf_counter()
+        result = ''
+        stream = self.llm.stream(text, stop=stop, **kwargs)
+        try:
+            for chunk in stream:
+                result += chunk if isinstance(chunk, str) else chunk.content  # Chat models stream message chunks
+                if self._first_statement_complete(result, start):
+                    break
+        finally:
+            stream.close()  # Closes the connection, i.e. cancels the request
+        return result
+
+    async def _apredict_first_statement(self, text: str, stop: Sequence[str] = None, **kwargs) -> str:
+        start = time.perf_counter()
+        result = ''
+        stream = self.llm.astream(text, stop=stop, **kwargs)
+        try:
+            async for chunk in stream:
+                result += chunk if isinstance(chunk, str) else chunk.content
+                if self._first_statement_complete(result, start):
+                    break
+        finally:
+            await stream.aclose()
+        return result
+
+    def _first_statement_complete(self, streamed_output: str, start: float) -> bool:
+        lines = streamed_output.lstrip().split('\n')
+        if len(lines[-1]) < 4:  # Too short to tell whether it is a continuation line
+            lines.pop()
+        if len(lines) > 1 and self._first_output_line(lines) < len(lines):
+            if self._verbose:
+                print(f'First statement complete after {time.perf_counter() - start:.2f}s, cancelling generation')
+            return True
+        return False
+
     def _split_llm_output(self, code_str_with_expected_reply):
+        if self._optimistic_execution:
+            # The output may contain further statements, the first one ends with the next prompt
+            code_str_with_expected_reply = code_str_with_expected_reply.split('\n>>>', 1)[0]
+        code_str_exec, expected_output_str = self._split_statement(code_str_with_expected_reply)
+        if self._verbose:
+            print('command:', code_str_exec)
+            print('expected output:', expected_output_str)
+        return code_str_exec, expected_output_str
+
+    @classmethod
+    def _split_statement(cls, code_str_with_expected_reply: str) -> Tuple[str, str]:
         lines = code_str_with_expected_reply.splitlines()
+        first_output_idx = cls._first_output_line(lines)
+        code_str_start = lines[0] + '\n' * (first_output_idx > 1)
+        code_str_exec = code_str_start + '\n'.join(
+            x[len('... '):] if x.startswith('...') else x  # Might start with spaces/indent directly
+            for x in lines[1:first_output_idx]
+        )
+        expected_output_str = '\n'.join(lines[first_output_idx:])
+        return code_str_exec, expected_output_str
+
+    @classmethod
+    def _parse_plan(cls, llm_output: str) -> List[Tuple[str, str]]:
+        """
+        The statements (with their expected output) that the LLM predicted after the first one, up to the first one
+        waiting for user input (whose response cannot be predicted)
+        """
+        statements = llm_output.strip().split('\n>>>')
+        if WAIT_FOR_USER_INPUT.search(cls._split_statement(statements[0])[0]):
+            return []
+        plan = []
+        complete = False
+        for statement in statements[1:]:
+            statement = statement.strip()
+            if not statement:
+                break
+            plan.append(cls._split_statement(statement))
+            if WAIT_FOR_USER_INPUT.search(plan[-1][0]):
+                complete = True
+                break
+        if plan and not complete:
+            plan.pop()  # The last statement might have been cut off by max_tokens
+        return plan
+
+    def _discard_plan(self, reason: str):
+        if self._plan:
+            print(f'Discarding {len(self._plan)} planned statements, {reason}')
+            self.optimistic_stats['discarded'] += len(self._plan)
+            self._plan.clear()
+
+    @staticmethod
+    def _first_output_line(lines: List[str]) -> int:
+        """Index of the first line after the first statement and its continuation lines, len(lines) if none"""
         prev_demands_continuation = False
         no_dots_continuation_mode = False
-        first_output_idx = len(lines)  # Default in case there is no expected output
         for i, line in enumerate(lines):
             if prev_demands_continuation and line.startswith('    '):
                 no_dots_continuation_mode = True
             no_dots_continuation_mode = no_dots_continuation_mode and line.startswith('    ')
             if i > 0 and not (prev_demands_continuation or line.startswith('...') or no_dots_continuation_mode):
-                first_output_idx = i
-                break
+                return i
             prev_demands_continuation = line.endswith(':') or line.endswith('\\')
-        code_str_start = lines[0] + '\n' * (first_output_idx > 1)
-        code_str_exec = code_str_start + '\n'.join(
-            x[len('... '):] if x.startswith('...') else x  # Might start with spaces/indent directly
-            for x in lines[1:first_output_idx]
-        )
-        expected_output_str = '\n'.join(lines[first_output_idx:])
-        if self._verbose:
-            print('command:', code_str_exec)
-            print('expected output:', expected_output_str)
-        return code_str_exec, expected_output_str
+        return len(lines)  # Default in case there is no expected output
 
     @staticmethod
     def _detect_generation_loop(generation_history):
@@ -279,3 +697,20 @@ class ReplLMP(LMPBase):
             self.code_execution_env.namespace.api.say(msg)
         else:
             print('SAY not available! Message:', msg)
+
+
+class _Speculation:
+    """Background generation of the statement following a long-running one, for the prompt expected after it"""
+
+    def __init__(self, prompt: Future, future: Future) -> None:
+        """
+        :param prompt: the speculative prompt, set as soon as it is built
+        :param future: the generated statement and the time it took
+        """
+        super().__init__()
+        self.prompt = prompt
+        self.future = future
+
+    def cancel(self):
+        self.future.cancel()
+        self.prompt.cancel()
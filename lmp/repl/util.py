@@ -1,8 +1,48 @@
+import re
 from dataclasses import dataclass
+from typing import List, Tuple
+
+END_OF_TASK = 'wait_for_trigger()'
+WAIT_FOR_USER_INPUT = re.compile(r"ask\(('[^']+'|\"[^\"]+\")\)|" + re.escape(END_OF_TASK))
+
+
+@dataclass(frozen=True, slots=True)
+class UserResponse:
+    """The line following a wait_for_trigger() or ask(...) in an execution history, i.e. the user's reply"""
+    item_index: int  # Index of the history item that contains the line
+    text: str
+
+
+def find_user_responses(text: str) -> Tuple[List[str], bool]:
+    """
+    Find the lines following a wait_for_trigger() or ask(...) in the given text.
+    Returns the response lines and whether the text ends with such a call, i.e. its response follows the text.
+    """
+    responses = []
+    awaiting_response = False
+    for match in WAIT_FOR_USER_INPUT.finditer(text):
+        newline_idx = match.end()
+        if newline_idx == len(text):
+            awaiting_response = True
+            continue
+        end_of_result_line = text.find('\n', newline_idx + 1)
+        if end_of_result_line == -1:
+            end_of_result_line = len(text)  # In case there is no trailing newline
+        response = text[newline_idx + 1:end_of_result_line]
+        if _is_response(response):
+            responses.append(response)
+    return responses, awaiting_response
+
+
+def _is_response(line: str):
+    # Otherwise, the "ask/wait_for_trigger" was part of a compound/control flow statement
+    return not (line.startswith('>>>') or line.startswith('...'))
 
 
 class ExecutionHistory:
-    @dataclass
+    # Items are immutable, so that their rendered strings can be cached.
+
+    @dataclass(frozen=True, slots=True)
     class Command:
         code: str  # without ">>>" or "..."
 
@@ -13,7 +53,7 @@ class ExecutionHistory:
                 result += '\n... ' + line
             return result
 
-    @dataclass
+    @dataclass(frozen=True, slots=True)
     class ExecutionResult:
         content: str
 
@@ -21,12 +61,141 @@ class ExecutionHistory:
             return self.content
 
     class InputPrompt:
+        __slots__ = ()
+
         def __str__(self):
             return '>>>'
 
-    def __init__(self) -> None:
+    __slots__ = ('items', 'user_responses', '_preceding_text_awaits_response', '_awaiting_response',
+                 '_rendered', '_ends', '_text', '_text_count')
+
+    def __init__(self, preceding_text='') -> None:
+        """
+        :param preceding_text: text that precedes the history in prompts (e.g. wait_for_trigger()),
+            only used to detect user responses
+        """
         super().__init__()
-        self.items = []
+        self.items = _HistoryItems(self)
+        # User responses, updated as items are appended. Used instead of searching the rendered history.
+        self.user_responses: List[UserResponse] = []
+        self._preceding_text_awaits_response = find_user_responses(preceding_text)[1]
+        self._awaiting_response: List[bool] = []  # For each item, whether it ends with ask(...)/wait_for_trigger()
+        self._rendered: List[str] = []  # str(item) for each item
+        self._ends: List[int] = []  # End offset of each item within str(self)
+        self._text = ''  # Rendered prefix, covering at least the first _text_count items
+        self._text_count = 0
+
+    def copy(self) -> 'ExecutionHistory':
+        """A copy that can be modified (or rendered) independently, e.g. in another thread. Items are shared."""
+        other = ExecutionHistory.__new__(ExecutionHistory)
+        other.items = _HistoryItems(other)
+        list.extend(other.items, self.items)  # Without rendering them again
+        other.user_responses = list(self.user_responses)
+        other._preceding_text_awaits_response = self._preceding_text_awaits_response
+        other._awaiting_response = list(self._awaiting_response)
+        other._rendered = list(self._rendered)
+        other._ends = list(self._ends)
+        other._text = self._text
+        other._text_count = self._text_count
+        return other
+
+    def _on_append(self, item):
+        rendered = str(item)
+        index = len(self._rendered)
+        self._rendered.append(rendered)
+        self._ends.append(self._ends[-1] + 1 + len(rendered) if self._ends else len(rendered))
+
+        previous_awaits_response = (self._awaiting_response[-1] if self._awaiting_response
+                                    else self._preceding_text_awaits_response)
+        responses, awaiting_response = find_user_responses(rendered)
+        if previous_awaits_response:
+            first_line = rendered.split('\n', 1)[0]
+            if _is_response(first_line):
+                responses.insert(0, first_line)
+        self._awaiting_response.append(awaiting_response)
+        self.user_responses.extend(UserResponse(index, r) for r in responses)
+
+    def _on_pop_last(self):
+        self._rendered.pop()
+        self._ends.pop()
+        self._awaiting_response.pop()
+        self._text_count = min(self._text_count, len(self._rendered))
+        while self.user_responses and self.user_responses[-1].item_index == len(self._rendered):
+            self.user_responses.pop()
+
+    def _on_modified(self):
+        self._rendered = []
+        self._ends = []
+        self._awaiting_response = []
+        self.user_responses = []
+        self._text = ''
+        self._text_count = 0
+        for item in self.items:
+            self._on_append(item)
+
+    @property
+    def rendered_items(self) -> List[str]:
+        """str(item) for each item (not to be modified)"""
+        return self._rendered
+
+    @property
+    def text_length(self):
+        """Length of str(self), without rendering it"""
+        return self._ends[-1] if self._ends else 0
 
     def __str__(self):
-        return '\n'.join(str(i) for i in self.items)
+        prefix_length = self._ends[self._text_count - 1] if self._text_count else 0
+        if len(self._text) > prefix_length:  # Items were popped after rendering
+            self._text = self._text[:prefix_length]
+        count = len(self._rendered)
+        if self._text_count < count:
+            new_text = '\n'.join(self._rendered[self._text_count:])
+            self._text = self._text + '\n' + new_text if self._text_count else new_text
+            self._text_count = count
+        return self._text
+
+
+class _HistoryItems(list):
+    """
+    The item list of an ExecutionHistory. Appending and popping the last item update the rendered history
+    incrementally, any other modification causes it to be rendered again.
+    """
+    __slots__ = ('_history',)
+
+    def __init__(self, history: ExecutionHistory):
+        super().__init__()
+        self._history = history
+
+    def append(self, item):
+        super().append(item)
+        self._history._on_append(item)
+
+    def pop(self, index=-1):
+        is_last = index == -1 or index == len(self) - 1
+        item = super().pop(index)
+        if is_last:
+            self._history._on_pop_last()
+        else:
+            self._history._on_modified()
+        return item
+
+    def _modifying(name):
+        def _apply(self, *args, **kwargs):
+            result = getattr(super(_HistoryItems, self), name)(*args, **kwargs)
+            self._history._on_modified()
+            return result
+
+        _apply.__name__ = name
+        return _apply
+
+    extend = _modifying('extend')
+    insert = _modifying('insert')
+    remove = _modifying('remove')
+    clear = _modifying('clear')
+    sort = _modifying('sort')
+    reverse = _modifying('reverse')
+    __setitem__ = _modifying('__setitem__')
+    __delitem__ = _modifying('__delitem__')
+    __iadd__ = _modifying('__iadd__')
+    __imul__ = _modifying('__imul__')
+    del _modifying
@@ -0,0 +1,268 @@
+"""
+Hosts many isolated REPL sessions in one long-running process, served over a local (unix domain) socket.
+
+Each session has its own ReplLMP with its own namespace (i.e. API object and locals) and execution history. The sessions
+share the loaded config, the embedding models, and the REPL's prompt builder, i.e. its prompt DB with the index and the
+learned prompts (see DynamicPromptBuilder.fork), so that an interaction learned in one session is retrieved in all
+others. The LMPs imported by the config (import_lmps, e.g. fgen) are set up for each session, like in a separate process:
+a DynamicCapLMP has its own prompt index and storage of learned examples per session, and picks up examples learned in
+other sessions only when it is created, or continuously if they share a memory_db (see lmp.memory_store).
+Sessions are driven by one event loop (see ReplLMP.acall), with LLM requests awaited concurrently and API calls run in a
+thread pool.
+
+Protocol: one JSON object per line in both directions. Requests name an operation and its arguments, e.g.
+    {"op": "create"}                                    -> {"ok": true, "result": "<session id>"}
+    {"op": "query", "session": "<id>", "query": "..."}  -> {"ok": true, "result": {"return": ..., "history": [...]}}
+    {"op": "interrupt" | "reset" | "close", "session": "<id>"}
+    {"op": "list"}                                      -> {"ok": true, "result": [{"session": "<id>", ...}, ...]}
+Errors are returned as {"ok": false, "error": "..."}. Requests of one connection are handled in order, use one
+connection per session to query sessions concurrently.
+
+Usage: python -m lmp.repl_server <module:api_factory> [config, relative to config/ and without .yaml] [socket path]
+"""
+import asyncio
+import copy
+import importlib
+import json
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Callable, Optional, List, Union
+
+from .api_visibility_wrapper import ApiVisibilityWrapper
+from .namespace import DynamicNamespaceDict
+from .repl.dynamic_prompt import DynamicPromptBuilder
+from .repl.repl_lmp import ReplLMP
+from .setup import load_config, setup_lmp
+
+DEFAULT_SOCKET_PATH = 'repl_server.sock'
+_STREAM_LIMIT = 2 ** 24  # Maximum length of a request or response line
+
+
+class ReplServerError(Exception):
+    """An error returned by the server"""
+
+
+class ReplSession:
+
+    def __init__(self, session_id: str, lmp: ReplLMP) -> None:
+        super().__init__()
+        self.session_id = session_id
+        self.lmp = lmp
+        self.lock = asyncio.Lock()  # One query at a time
+        self.created = self.last_active = time.time()
+        self.num_queries = 0
+
+    def info(self) -> Dict:
+        return dict(session=self.session_id, created=self.created, last_active=self.last_active,
+                    num_queries=self.num_queries, busy=self.lock.locked(),
+                    history_items=len(self.lmp.exec_hist.items))
+
+
+class ReplServer:
+    OPERATIONS = {
+        'create': 'create_session',
+        'query': 'query',
+        'interrupt': 'interrupt',
+        'reset': 'reset_session',
+        'close': 'close_session',
+        'list': 'sessions',
+    }
+
+    def __init__(self, cfg: Dict, api_factory: Callable[[], object],
+                 namespace_factory: Callable[[object], DynamicNamespaceDict] = DynamicNamespaceDict,
+                 max_sessions=256, max_workers=64) -> None:
+        """
+        :param cfg: a loaded (see lmp.setup.load_config) repl config
+        :param api_factory: creates the API object of a new session (e.g. connected to its robot or simulation)
+        :param namespace_factory: creates the namespace of a session from its API object, e.g. adding common packages
+        :param max_workers: threads for blocking work of all sessions, i.e. API calls and building prompts
+        """
+        super().__init__()
+        if cfg.get('type') != 'repl':
+            raise ValueError(f'Only repl configs can be served, not {cfg.get("type")}')
+        self.cfg = dict(cfg)
+        self._api_cfg = self.cfg.pop('api', None)
+        self._api_factory = api_factory
+        self._namespace_factory = namespace_factory
+        self.max_sessions = max_sessions
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='repl-session')
+        self._sessions: Dict[str, ReplSession] = {}
+        self._num_creating = 0
+        # Of the first session, forked for the others (imported LMPs are not shared, see the module docstring)
+        self._prompt_builder: Optional[DynamicPromptBuilder] = None
+        self._setup_lock = threading.Lock()
+
+    def _session(self, session_id: str) -> ReplSession:
+        try:
+            return self._sessions[session_id]
+        except KeyError:
+            raise KeyError(f'No session {session_id}') from None
+
+    async def create_session(self, session_id: str = None) -> str:
+        session_id = session_id or uuid.uuid4().hex
+        if session_id in self._sessions:
+            raise ValueError(f'Session {session_id} already exists')
+        if len(self._sessions) + self._num_creating >= self.max_sessions:
+            raise RuntimeError(f'Too many sessions (max_sessions={self.max_sessions})')
+        self._num_creating += 1
+        try:
+            lmp = await asyncio.get_running_loop().run_in_executor(self._executor, self._setup_lmp)
+        finally:
+            self._num_creating -= 1
+        if session_id in self._sessions:  # Created concurrently
+            lmp.close()
+            raise ValueError(f'Session {session_id} already exists')
+        self._sessions[session_id] = ReplSession(session_id, lmp)
+        return session_id
+
+    def _setup_lmp(self) -> ReplLMP:
+        api = self._api_factory()
+        if self._api_cfg is not None:
+            api = ApiVisibilityWrapper(api, **self._api_cfg)
+        namespace = self._namespace_factory(api)
+        cfg = copy.deepcopy(self.cfg)  # Setup pops e.g. the llm types from (nested) configs
+        with self._setup_lock:
+            if self._prompt_builder is None:
+                lmp = setup_lmp(cfg, namespace)
+                self._prompt_builder = lmp.prompt_builder
+                return lmp
+        return setup_lmp(cfg, namespace, prompt_builder=self._prompt_builder.fork())
+
+    async def query(self, session_id: str, query: Union[str, dict]) -> Dict:
+        """:return: the value returned by the session's result function, and the execution history of the query"""
+        session = self._session(session_id)
+        async with session.lock:
+            session.last_active = time.time()
+            session.num_queries += 1
+            exec_hist = session.lmp.exec_hist  # Might be replaced by a reset at the end of the query
+            start = len(exec_hist.items)
+            result = await session.lmp.acall(query, self._executor)
+            session.last_active = time.time()
+        return {'return': None if result is None else repr(result),
+                'history': [str(item) for item in exec_hist.items[start:]]}
+
+    def interrupt(self, session_id: str):
+        """The running query of the session ends after the currently executed statement"""
+        self._session(session_id).lmp.interrupt()
+
+    async def reset_session(self, session_id: str):
+        session = self._session(session_id)
+        async with session.lock:
+            session.lmp.reset()
+
+    async def close_session(self, session_id: str):
+        session = self._session(session_id)
+        session.lmp.interrupt()
+        async with session.lock:
+            self._sessions.pop(session_id, None)
+            session.lmp.close()
+
+    def sessions(self) -> List[Dict]:
+        return [s.info() for s in self._sessions.values()]
+
+    async def serve(self, socket_path=DEFAULT_SOCKET_PATH):
+        Path(socket_path).unlink(missing_ok=True)  # Left over from a previous run
+        server = await asyncio.start_unix_server(self._handle_connection, socket_path, limit=_STREAM_LIMIT)
+        print('Serving REPL sessions on', socket_path)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                response = await self._handle_request(line)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line: bytes) -> Dict:
+        try:
+            request = json.loads(line)
+            op = request.pop('op')
+            if op not in self.OPERATIONS:
+                raise ValueError(f'Unknown operation {op}, expected one of {list(self.OPERATIONS)}')
+            if 'session' in request:
+                request['session_id'] = request.pop('session')
+            result = getattr(self, self.OPERATIONS[op])(**request)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return {'ok': True, 'result': result}
+        except Exception as e:
+            traceback.print_exc()
+            return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+    def close(self):
+        for session in self._sessions.values():
+            session.lmp.close()
+        self._sessions.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ReplClient:
+    """Client of a ReplServer, for one session at a time (use several clients to query sessions concurrently)"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH) -> None:
+        super().__init__()
+        self.socket_path = socket_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path, limit=_STREAM_LIMIT)
+
+    async def request(self, op: str, **kwargs):
+        if self._writer is None:
+            await self.connect()
+        self._writer.write(json.dumps(dict(op=op, **kwargs)).encode() + b'\n')
+        await self._writer.drain()
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by the server')
+        response = json.loads(line)
+        if not response['ok']:
+            raise ReplServerError(response['error'])
+        return response['result']
+
+    async def create_session(self, session_id: str = None) -> str:
+        return await self.request('create', **({'session': session_id} if session_id else {}))
+
+    async def query(self, session_id: str, query: Union[str, dict]) -> Dict:
+        return await self.request('query', session=session_id, query=query)
+
+    async def close_session(self, session_id: str):
+        await self.request('close', session=session_id)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = self._reader = None
+
+
+def _import_factory(spec: str) -> Callable:
+    module_name, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), name)
+
+
+def main(api_factory: str, cfg_path='cap_tabletop/repl_flat_fgen/repl', socket_path=DEFAULT_SOCKET_PATH):
+    cfg = load_config(Path(__file__).parent.parent / 'config' / f'{cfg_path}.yaml')
+    server = ReplServer(cfg, _import_factory(api_factory))
+    try:
+        asyncio.run(server.serve(socket_path))
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    main(*sys.argv[1:4])
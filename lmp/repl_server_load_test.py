@@ -0,0 +1,123 @@
+"""
+Load test of lmp.repl_server: starts a server in this process, with a local fake LLM (see lmp.fake_llm) and a fake
+tabletop API, and lets many clients create a session each, send queries concurrently and close their session again.
+Reports query latencies and throughput.
+
+Usage: python -m lmp.repl_server_load_test [sessions] [queries per session] [LLM latency per token in s]
+    [API call latency in s] [config, relative to config/ and without .yaml]
+"""
+import asyncio
+import contextlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+from .namespace import comment
+from .repl.code_execution import ReplExecutionEnvironment
+from .repl_server import ReplServer, ReplClient
+from .setup import load_config
+
+# The statements "generated" in turn, for each query
+_RESPONSES = [
+    "objs = get_obj_names()",
+    "put_first_on_second('red block', 'blue bowl')\n'success'",
+    "wait_for_trigger()",
+]
+
+
+class LoadTestAPI:
+    """Tabletop API without simulation, actions just take some time"""
+
+    def __init__(self, action_latency=0.0):
+        self.action_latency = action_latency
+
+    def wait_for_trigger(self):
+        raise StopIteration((ReplExecutionEnvironment.RETURN_FN_SIGNAL, None))
+
+    def get_obj_names(self):
+        return ['red block', 'blue block', 'blue bowl']
+
+    @comment('2D xy position')
+    def get_obj_pos(self, obj_name):
+        return [0.1, 0.2]
+
+    def denormalize_xy(self, pos_normalized):
+        return pos_normalized
+
+    @comment('move gripper to object 1, pick it up, move to target, release the gripper')
+    def put_first_on_second(self, obj_name_1: str, target_name_or_xy_pos: str):
+        time.sleep(self.action_latency)  # Blocking, like the robot
+        return 'success'
+
+
+def _load_test_cfg(cfg_path: str, llm_latency: float, tmp_dir: Path):
+    cfg = load_config(Path(__file__).parent.parent / 'config' / f'{cfg_path}.yaml')
+    fake_llm = dict(type='FakeStreamingLLM', responses=_RESPONSES, chunk_latency=llm_latency)
+    cfg['llm'] = fake_llm
+    cfg['verbose'] = False
+    cfg['learn_from_interaction_cfg'] = dict(type='no-improve')
+    cfg['prompt_cfg'] = dict(cfg['prompt_cfg'], custom_prompt_db_file=tmp_dir / 'dynamic_prompt_db.json',
+                             embedding_cache_dir=tmp_dir / 'embeddings')
+    cfg['prompt_cfg'].pop('memory_db', None)
+    cfg['import_lmps'] = {name: dict(sub_cfg, llm=dict(fake_llm)) for name, sub_cfg in cfg['import_lmps'].items()}
+    return cfg
+
+
+async def _client(socket_path: str, num_queries: int, latencies: List[float]):
+    client = ReplClient(socket_path)
+    try:
+        session = await client.create_session()
+        for i in range(num_queries):
+            start = time.perf_counter()
+            await client.query(session, f'put the red block in the blue bowl ({i})')
+            latencies.append(time.perf_counter() - start)
+        await client.close_session(session)
+    finally:
+        await client.close()
+
+
+async def _run(server: ReplServer, socket_path: str, num_sessions: int, num_queries: int):
+    serving = asyncio.create_task(server.serve(socket_path))
+    while not os.path.exists(socket_path):
+        await asyncio.sleep(0.01)
+    # The first session builds the prompt index, which the others share
+    start = time.perf_counter()
+    await _client(socket_path, 1, [])
+    warmup_time = time.perf_counter() - start
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(socket_path, num_queries, latencies) for _ in range(num_sessions)])
+    duration = time.perf_counter() - start
+    serving.cancel()
+    return warmup_time, duration, latencies
+
+
+def main(num_sessions=50, num_queries=3, llm_latency=0.01, action_latency=0.1,
+         cfg_path='cap_tabletop/repl_flat_fgen/repl'):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cfg = _load_test_cfg(cfg_path, llm_latency, Path(tmp_dir))
+        server = ReplServer(cfg, lambda: LoadTestAPI(action_latency), max_sessions=num_sessions + 1)
+        socket_path = os.path.join(tmp_dir, 'repl_server.sock')
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # The sessions' output
+                warmup_time, duration, latencies = asyncio.run(_run(server, socket_path, num_sessions, num_queries))
+        finally:
+            server.close()
+
+    latencies.sort()
+    print(f'{num_sessions} sessions x {num_queries} queries ({len(_RESPONSES)} statements each), '
+          f'LLM latency {llm_latency}s/token, API call latency {action_latency}s')
+    print(f'First query (building the shared prompt index): {warmup_time:.2f}s')
+    print(f'Total: {duration:.2f}s, {len(latencies) / duration:.1f} queries/s')
+    print(f'Query latency: mean {statistics.mean(latencies):.3f}s, '
+          f'p50 {latencies[len(latencies) // 2]:.3f}s, p95 {latencies[int(len(latencies) * 0.95)]:.3f}s, '
+          f'max {latencies[-1]:.3f}s')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]], *[float(a) for a in sys.argv[3:5]], *sys.argv[5:6])
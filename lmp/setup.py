@@ -7,8 +7,10 @@ import yaml
 from langchain.chat_models.base import BaseChatModel
 from langchain.schema.language_model import BaseLanguageModel
 
+import lmp.fake_llm
 import lmp.repl.error_handlers
 from .code_execution import CodeExecutionEnvironment
+from .embedding_models import get_embedding_model
 from .function_gen_lmp import FunctionGenerationLMP
 from .lmp import LMP, LMPBase
 from .namespace import DynamicNamespaceDict
@@ -19,11 +21,13 @@ from .repl.repl_lmp import ReplLMP
 
 
 def load_config(cfg_file: Path) -> Dict:
+    """Also starts loading the embedding models used by the config in the background"""
     loaded_cfgs = {}
 
     def _load(f: Path):
         cfg = yaml.safe_load(f.read_text())
         _load_prompts(cfg, f)
+        _preload_embedding_model(cfg)
         loaded_cfgs[str(f.resolve())] = cfg
         imported_cfgs = {}
         for sub_name, sub_f in cfg.pop('import_lmps', {}).items():
@@ -48,6 +52,17 @@ def _load_prompts(cfg, base_f):
         prompt_file = _resolve_rel_path(name, '.prompt.py')
         return prompt_file.read_text().strip()
 
+    def _load_prompt_db(include_paths):
+        prompts = []
+        for include_path in include_paths:
+            if '*' in include_path:
+                # Sorted, for deterministic prompts
+                for prompt_f in sorted(base_f.parent.glob(f'{include_path}.prompt.py')):
+                    prompts.append(prompt_f.resolve().read_text().strip())
+            else:
+                prompts.append(_load_prompt_file(include_path))
+        return prompts
+
     if 'prompt_cfg' in cfg:
         prompt_cfg = cfg['prompt_cfg']
         prompts = []
@@ -61,23 +76,42 @@ def _load_prompts(cfg, base_f):
             new_prompt_cfg['prompt_suffix'] = _load_prompt_file(prompt_cfg.pop('suffix'))
         if 'custom_prompt_db_file' in prompt_cfg:
             new_prompt_cfg['custom_prompt_db_file'] = _resolve_rel_path(prompt_cfg.pop('custom_prompt_db_file'))
-        for include_path in prompt_cfg.pop('db'):
-            if '*' in include_path:
-                for prompt_f in base_f.parent.glob(f'{include_path}.prompt.py'):
-                    prompts.append(prompt_f.resolve().read_text().strip())
-            else:
-                prompts.append(_load_prompt_file(include_path))
+        if prompt_cfg.get('memory_db'):
+            new_prompt_cfg['memory_db'] = _resolve_rel_path(prompt_cfg.pop('memory_db'))
+        if prompt_cfg.get('embedding_cache_dir'):
+            new_prompt_cfg['embedding_cache_dir'] = _resolve_rel_path(prompt_cfg.pop('embedding_cache_dir'))
+        prompts.extend(_load_prompt_db(prompt_cfg.pop('db')))
+        if 'pinned' in prompt_cfg:
+            new_prompt_cfg['pinned_prompt_db'] = _load_prompt_db(prompt_cfg.pop('pinned'))
         new_prompt_cfg.update(prompt_cfg)
         cfg['prompt_cfg'] = new_prompt_cfg
     elif cfg.get('type') != 'helper':
         cfg['prompt_text'] = _load_prompt_file(base_f.stem)
+    elif cfg.get('memory_db'):
+        cfg['memory_db'] = _resolve_rel_path(cfg['memory_db'])
 
     if 'learn_from_interaction_cfg' in cfg and 'few_shot_file' in cfg['learn_from_interaction_cfg']:
         cfg['learn_from_interaction_cfg']['few_shot_file'] = _resolve_rel_path(
             cfg['learn_from_interaction_cfg']['few_shot_file'])
 
 
-def setup_lmp(cfg: Dict, namespace: DynamicNamespaceDict) -> LMPBase:
+def _preload_embedding_model(cfg):
+    prompt_cfg = cfg.get('prompt_cfg', {})
+    if 'sentence_similarity_model' in prompt_cfg:
+        get_embedding_model(prompt_cfg['sentence_similarity_model'], embedding_model_device(cfg))
+
+
+def embedding_model_device(cfg):
+    # Same defaults as DynamicPromptBuilder and DynamicCapLMP, so that they get the preloaded model
+    default_device = 'cpu' if cfg.get('type') == 'repl' else None
+    return cfg['prompt_cfg'].get('device', default_device) or None
+
+
+def setup_lmp(cfg: Dict, namespace: DynamicNamespaceDict, prompt_builder: DynamicPromptBuilder = None) -> LMPBase:
+    """
+    :param prompt_builder: for a repl config, use this instead of creating one from the prompt_cfg (e.g. a fork of the
+        one of another session, see DynamicPromptBuilder.fork)
+    """
     cfg = dict(cfg)  # Copy to keep "pop"s locally, since loaded dict might be shared on multi-way imports
     lmp_type = cfg.pop('type', 'lmp')
     llm = _instantiate_llm(cfg.pop('llm', {}))
@@ -98,7 +132,11 @@ def setup_lmp(cfg: Dict, namespace: DynamicNamespaceDict) -> LMPBase:
         if 'result_function' in cfg:
             exec_env.set_result_function_name(cfg.pop('result_function'))
 
-        prompt_builder = DynamicPromptBuilder(**cfg.pop('prompt_cfg'))
+        prompt_cfg = dict(cfg.pop('prompt_cfg'))
+        if getattr(llm, 'model_name', None):
+            prompt_cfg.setdefault('tokenizer', llm.model_name)  # Count tokens for token_budget like the LLM does
+        if prompt_builder is None:
+            prompt_builder = DynamicPromptBuilder(**prompt_cfg)
         if 'learn_from_interaction_cfg' in cfg:
             learn_from_interaction = _instantiate_learn_from_interaction(cfg.pop('learn_from_interaction_cfg'))
         else:
@@ -124,8 +162,10 @@ def setup_lmp(cfg: Dict, namespace: DynamicNamespaceDict) -> LMPBase:
             return FunctionGenerationLMP(cfg, llm, exec_env)
         elif lmp_type == 'helper':
             from helper_llm.helper_lmp import HelperLMP
+            from helper_llm.prompt_db import HelperPromptDB
             return HelperLMP(
-                llm, exec_env, top_k=cfg.pop('top_k', 3)
+                llm, exec_env, top_k=cfg.pop('top_k', 3), retrieval=cfg.pop('retrieval', None),
+                prompt_db=HelperPromptDB(memory_db=cfg.pop('memory_db', None))
             )
         elif lmp_type == 'dynamic_cap_lmp':
             from lmp.dynamic_cap_lmp import DynamicCapLMP
@@ -155,7 +195,7 @@ def _instantiate_llm(llm_cfg: Dict) -> BaseLanguageModel:
         llm_cfg['openai_api_key'] = openai.api_key
         llm_cfg.setdefault('request_timeout', 30)
 
-    return _instantiate_from_cfg(llm_cfg, langchain.llms, langchain.chat_models)
+    return _instantiate_from_cfg(llm_cfg, langchain.llms, langchain.chat_models, lmp.fake_llm)
 
 
 def _instantiate_from_cfg(cfg: Dict, *base_pkgs):
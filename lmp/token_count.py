@@ -0,0 +1,53 @@
+import threading
+from functools import cached_property
+from typing import Dict
+
+import tiktoken
+
+DEFAULT_TOKENIZER = 'cl100k_base'
+
+
+class TokenCounter:
+    """Number of tokens of texts, with tiktoken. Counts are cached per text, since prompt parts recur every round."""
+
+    def __init__(self, tokenizer: str = DEFAULT_TOKENIZER, cache_size=100_000) -> None:
+        """
+        :param tokenizer: a tiktoken encoding, or the name of a model whose encoding to use (e.g. gpt-4)
+        :param cache_size: the cache is cleared when it reaches this many texts
+        """
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache: Dict[str, int] = {}
+
+    @cached_property
+    def encoding(self) -> tiktoken.Encoding:
+        try:
+            return tiktoken.encoding_for_model(self.tokenizer)
+        except KeyError:
+            return tiktoken.get_encoding(self.tokenizer)
+
+    def __call__(self, text: str) -> int:
+        count = self._cache.get(text)
+        if count is None:
+            count = self.count_uncached(text)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[text] = count
+        return count
+
+    def count_uncached(self, text: str) -> int:
+        """For texts which are unlikely to be counted again"""
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+_counters: Dict[str, TokenCounter] = {}
+_counters_lock = threading.Lock()
+
+
+def get_token_counter(tokenizer: str = DEFAULT_TOKENIZER) -> TokenCounter:
+    """Counters (and their caches) are shared within the process"""
+    with _counters_lock:
+        if tokenizer not in _counters:
+            _counters[tokenizer] = TokenCounter(tokenizer)
+        return _counters[tokenizer]
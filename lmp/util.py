@@ -1,9 +1,27 @@
+import hashlib
 from pathlib import Path
 
 from langchain import PromptTemplate
 from langchain.prompts import HumanMessagePromptTemplate, AIMessagePromptTemplate, SystemMessagePromptTemplate
 
 
+def text_key(text: str):
+    """Content hash, to refer to (potentially long) texts such as prompts in caches and databases"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    # Binary search with slice comparisons, much faster than comparing character by character in Python
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
 def print_code(code, name=None, force_color=False):
     import sys
 
@@ -0,0 +1,235 @@
+import math
+from typing import Optional, Dict, Tuple, List
+
+import torch
+
+
+class GrowingTensor:
+    """Tensor which can be extended along the first dimension in amortized constant time per row"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._buffer: Optional[torch.Tensor] = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def tensor(self) -> Optional[torch.Tensor]:
+        return None if self._buffer is None else self._buffer[:self._size]
+
+    def append(self, rows: torch.Tensor):
+        new_size = self._size + len(rows)
+        if self._buffer is None or new_size > len(self._buffer):
+            capacity = max(new_size, 2 * (0 if self._buffer is None else len(self._buffer)), 64)
+            buffer = torch.empty((capacity,) + rows.shape[1:], dtype=rows.dtype, device=rows.device)
+            if self._buffer is not None:
+                buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+        self._buffer[self._size:new_size] = rows
+        self._size = new_size
+
+
+class VectorSearch:
+    """Maximum inner product search over an append-only set of (normalized) vectors"""
+
+    def __len__(self):
+        raise NotImplementedError
+
+    @property
+    def nbytes(self):
+        """Memory used by the stored vectors"""
+        raise NotImplementedError
+
+    def add(self, vectors: torch.Tensor):
+        raise NotImplementedError
+
+    def search(self, query: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return: similarities and row indices of (up to) the k most similar vectors, most similar first.
+            Fewer than k results mean that there are no more candidates.
+        """
+        raise NotImplementedError
+
+
+class ExactSearch(VectorSearch):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._vectors = GrowingTensor()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    @property
+    def vectors(self) -> Optional[torch.Tensor]:
+        return self._vectors.tensor
+
+    @property
+    def nbytes(self):
+        return 0 if self.vectors is None else self.vectors.numel() * self.vectors.element_size()
+
+    def add(self, vectors: torch.Tensor):
+        self._vectors.append(vectors)
+
+    def search(self, query: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        similarities = self.vectors @ query
+        return torch.topk(similarities, min(k, len(similarities)))
+
+
+class IVFSearch(ExactSearch):
+    """
+    Inverted file index: vectors are clustered with k-means, and a query only scans the vectors of the num_probes
+    clusters with the most similar centroids. More probes give better recall at higher latency.
+
+    Small sets are searched exactly. The clustering is recomputed whenever the set has doubled since the last one,
+    vectors added in between are assigned to the nearest existing centroid.
+    """
+
+    def __init__(self, num_lists: int = None, num_probes: int = 8, exact_below: int = 5000,
+                 kmeans_iterations: int = 10, seed: int = 0) -> None:
+        """
+        :param num_lists: number of clusters. Default: sqrt of the number of vectors at (re)training time
+        :param num_probes: number of clusters to scan per query
+        :param exact_below: use exact search while there are less vectors than this
+        """
+        super().__init__()
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.exact_below = exact_below
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self._centroids: Optional[torch.Tensor] = None
+        self._trained_size = 0
+        self._lists: List[List[int]] = []
+        self._list_tensors: Dict[int, torch.Tensor] = {}  # Cache, invalidated on add
+
+    def add(self, vectors: torch.Tensor):
+        first_row = len(self)
+        super().add(vectors)
+        if len(self) < self.exact_below:
+            return
+        if self._centroids is None or len(self) >= 2 * self._trained_size:
+            self._train()
+        else:
+            self._assign(first_row, (vectors @ self._centroids.T).argmax(dim=1))
+
+    def _train(self):
+        vectors = self.vectors
+        num_lists = self.num_lists or max(1, int(math.sqrt(len(vectors))))
+        generator = torch.Generator().manual_seed(self.seed)
+        centroids = vectors[torch.randperm(len(vectors), generator=generator)[:num_lists].to(vectors.device)]
+        for _ in range(self.kmeans_iterations):
+            assignment = (vectors @ centroids.T).argmax(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+            counts = torch.bincount(assignment, minlength=len(centroids))
+            non_empty = counts > 0
+            # Spherical k-means: normalized mean. Empty clusters keep their previous centroid.
+            centroids[non_empty] = torch.nn.functional.normalize(sums[non_empty], dim=-1)
+        self._centroids = centroids
+        self._trained_size = len(vectors)
+        self._lists = [[] for _ in range(len(centroids))]
+        self._assign(0, (vectors @ centroids.T).argmax(dim=1))
+
+    def _assign(self, first_row: int, assignment: torch.Tensor):
+        for i, list_idx in enumerate(assignment.tolist()):
+            self._lists[list_idx].append(first_row + i)
+            self._list_tensors.pop(list_idx, None)
+
+    def _list_tensor(self, list_idx: int):
+        if list_idx not in self._list_tensors:
+            self._list_tensors[list_idx] = torch.tensor(self._lists[list_idx], dtype=torch.long,
+                                                        device=self._centroids.device)
+        return self._list_tensors[list_idx]
+
+    def search(self, query: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self._centroids is None:
+            return super().search(query, k)
+        # Probe further lists if the first num_probes do not contain k vectors
+        lists = []
+        num_rows = 0
+        for i in torch.argsort(self._centroids @ query, descending=True).tolist():
+            if len(lists) >= self.num_probes and num_rows >= k:
+                break
+            lists.append(self._list_tensor(i))
+            num_rows += len(lists[-1])
+        rows = torch.cat(lists)
+        similarities = self.vectors[rows] @ query
+        values, indices = torch.topk(similarities, min(k, len(similarities)))
+        return values, rows[indices]
+
+
+class QuantizedSearch(VectorSearch):
+    """
+    Exact search over vectors stored as float16, or as int8 with one scale per row (2x / 4x less memory than float32).
+    Vectors are kept on the CPU and dequantized on the fly, chunk by chunk (sized to stay in cache), for the dot product.
+    """
+
+    PRECISIONS = ('float16', 'int8')
+
+    def __init__(self, precision: str = 'int8', chunk_size=4096) -> None:
+        super().__init__()
+        if precision not in self.PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, expected one of {self.PRECISIONS}')
+        self.precision = precision
+        self.chunk_size = chunk_size
+        self._vectors = GrowingTensor()
+        self._scales = GrowingTensor()  # int8 only
+
+    def __len__(self):
+        return len(self._vectors)
+
+    @property
+    def nbytes(self):
+        return sum(0 if t.tensor is None else t.tensor.numel() * t.tensor.element_size()
+                   for t in (self._vectors, self._scales))
+
+    def add(self, vectors: torch.Tensor):
+        vectors = vectors.detach().float().cpu()
+        if self.precision == 'float16':
+            self._vectors.append(vectors.half())
+        else:
+            scales = vectors.abs().amax(dim=1).clamp(min=1e-12) / 127
+            self._vectors.append(torch.round(vectors / scales[:, None]).to(torch.int8))
+            self._scales.append(scales)
+
+    def similarities(self, query: torch.Tensor) -> torch.Tensor:
+        query = query.detach().float().cpu()
+        vectors = self._vectors.tensor
+        result = torch.empty(len(vectors))
+        for start in range(0, len(vectors), self.chunk_size):
+            result[start:start + self.chunk_size] = vectors[start:start + self.chunk_size].float() @ query
+        if self.precision == 'int8':
+            result *= self._scales.tensor
+        return result
+
+    def search(self, query: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        values, rows = torch.topk(self.similarities(query), min(k, len(self)))
+        return values.to(query.device), rows.to(query.device)
+
+
+def create_vector_search(cfg: Optional[Dict] = None) -> VectorSearch:
+    """
+    Create a vector search from the "retrieval" config, e.g.
+        retrieval:
+          type: ivf  # or exact (default)
+          num_probes: 8
+          exact_below: 5000
+    or, for exact search over quantized vectors:
+        retrieval:
+          precision: int8  # or float16, float32 (default)
+    """
+    cfg = dict(cfg or {})
+    t = cfg.pop('type', 'exact')
+    precision = cfg.pop('precision', 'float32')
+    if precision != 'float32':
+        if t != 'exact':
+            raise ValueError(f'precision {precision} is only supported by exact retrieval')
+        return QuantizedSearch(precision, **cfg)
+    if t == 'exact':
+        return ExactSearch()
+    elif t == 'ivf':
+        return IVFSearch(**cfg)
+    else:
+        raise ValueError(f'Unknown retrieval type {t}')